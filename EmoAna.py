@@ -1,7 +1,39 @@
+import deepface
 from deepface import DeepFace
+from deepface.modules import preprocessing
 import cv2
 import numpy as np
 import os
+import threading
+import time
+from collections import OrderedDict
+from EmoCache import resultCache
+from EmoResults import faceResults, EMOTION_LABELS, GENDER_LABELS, RACE_LABELS, PROBABILITY_FIELDS
+from EmoMetrics import metrics, stageTimer, profiled, timings_text
+from EmoOptions import ACTION_PROFILES, DEFAULT_PROFILE, DETECTOR_BACKENDS, DEFAULT_DETECTOR, INFERENCE_ENGINES, \
+    DEFAULT_ENGINE
+from EmoEngine import onnxEngine
+
+# 每个分析动作对应的 DeepFace 属性模型名
+ACTION_MODELS = {'age': 'Age', 'gender': 'Gender', 'race': 'Race', 'emotion': 'Emotion'}
+
+# 同一个人不会变化的属性：识别出已知人物时可以直接复用缓存的值（情绪每次都重新计算）
+SUBJECT_ATTRIBUTES = {'age': ['age'], 'gender': ['gender', 'dominant_gender'], 'race': ['race', 'dominant_race']}
+# 人脸身份索引默认使用的特征提取模型
+DEFAULT_RECOGNIZER = 'Facenet'
+# JPEG 缩小解码允许比分析分辨率上限略小的比例（见 deepAnalysis.decode_img）
+REDUCED_DECODE_MIN = 0.9
+
+# 结果图信息面板的排版：是否紧凑（多张人脸）-> (字号, 线宽, 行高)
+OVERLAY_STYLE = {False: (1, 2, 30), True: (0.5, 1, 20)}
+OVERLAY_COLOR = (0, 0, 0)  # 黑色
+OVERLAY_TOP = 40
+OVERLAY_COLUMN_WIDTH = 400  # 每列信息区域宽度
+
+
+# 分析被取消时抛出，进度回调中抛出该异常即可在下一个阶段边界中止流水线
+class AnalysisCancelled(Exception):
+    pass
 
 
 # 分析人脸
@@ -9,89 +41,289 @@ class deepAnalysis:
     def __init__(self):
         pass
 
-    def Analysis(img_path):
-        objs = DeepFace.analyze(img_path=img_path, actions=['age', 'gender', 'race', 'emotion'])
-        print(objs)
+    # 把预设名或动作列表统一转换成 DeepFace 需要的动作列表
+    def resolve_actions(actions=DEFAULT_PROFILE):
+        if isinstance(actions, str):
+            if actions not in ACTION_PROFILES:
+                raise ValueError(f"未知的分析模式: {actions}，可选: {', '.join(ACTION_PROFILES)}")
+            return list(ACTION_PROFILES[actions])
+
+        actions = list(actions)
+        unknown = [action for action in actions if action not in ACTION_PROFILES['full']]
+        if unknown or not actions:
+            raise ValueError(f"不支持的分析动作: {unknown or actions}")
+        return actions
+
+    # img_path 既可以是图片路径，也可以是已经解码好的 BGR 数组；
+    # detect_max_side 不为空时先把图片缩小到最长边不超过该值再检测，结果中的人脸框会换算回原图坐标。
+    # 检测和各属性模型分开执行（与 DeepFace.analyze 的结果结构相同），timer 中会记录每一步的耗时；
+    # 传入 index（EmoIndex.faceIndex）时先按人脸特征查找身份，结果中附带 identity，已知人物的年龄、性别、人种直接复用；
+    # engine 为属性模型的推理引擎（INFERENCE_ENGINES）
+    def Analysis(img_path, actions=DEFAULT_PROFILE, detector_backend=DEFAULT_DETECTOR, align=True,
+                 detect_max_side=None, timer=None, index=None, engine=DEFAULT_ENGINE):
+        actions = deepAnalysis.resolve_actions(actions)
+        timer = timer or stageTimer()
+        # 模型由注册表统一加载，已加载时直接返回，避免后台预加载和分析同时构建同一个模型
+        modelRegistry.load([action for action in actions if not onnxEngine.supports(engine, action)],
+                           detector_backend=detector_backend)
+
+        img = img_path
+        if isinstance(img_path, str):
+            with timer.span('decode'):
+                img = deepAnalysis.read_img(img_path)
+
+        # 与 DeepFace.analyze 一致：检测不到人脸时抛出 ValueError
+        with timer.span('detect'):
+            face_objs = deepAnalysis.detect_faces(img, detector_backend=detector_backend, align=align,
+                                                  detect_max_side=detect_max_side, enforce_detection=True)
+        if index is None:
+            return deepAnalysis.predict_batch(face_objs, actions, timer=timer, engine=engine)
+
+        face_objs = [face for face in face_objs if face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+        with timer.span('identify'):
+            embeddings = deepAnalysis.embed_faces(face_objs, index.model_name)
+            matches = index.search(embeddings)
+        known = [index.attributes(match[0]) if match else None for match in matches]
+        objs = deepAnalysis.predict_batch(face_objs, actions, timer=timer, known=known, engine=engine)
+        index.record(embeddings, matches, objs)
         return objs
 
-    # 读取原始图片
-    def plot_Ana_img(img_path, objs):
-        img = cv2.imread(img_path)
-        if img is None:
-            print(f"无法读取图片: {img_path}")
-            exit()
-
-        # 在人脸上绘制边框
-        face_data = objs[0]
-        region = face_data['region']
-        x, y, w, h = region['x'], region['y'], region['w'], region['h']
-
-        # 创建原图的副本，以保留原图
-        img_with_box = img.copy()
-        cv2.rectangle(img_with_box, (x, y), (x + w, y + h), (0, 0, 255), 2)  # 红色边框
-
-        # 获取图片尺寸
+    # 只做人脸检测，返回 DeepFace.extract_faces 的结果（face 为 RGB、取值 0~1），人脸框为原图坐标
+    def detect_faces(img, detector_backend=DEFAULT_DETECTOR, align=True, detect_max_side=None,
+                     enforce_detection=False):
+        modelRegistry.load([], detector_backend=detector_backend)
+        img, scale = deepAnalysis.downscale(img, detect_max_side)
+        face_objs = DeepFace.extract_faces(img_path=img, detector_backend=detector_backend,
+                                           enforce_detection=enforce_detection, align=align)
+        if scale != 1.0:
+            for face in face_objs:
+                face['facial_area'] = deepAnalysis.scale_region(face['facial_area'], scale)
+        return face_objs
+
+    # 把图片缩小到最长边不超过 max_side，返回 (缩小后的图片, 缩放比例)；不需要缩小时原样返回
+    def downscale(img, max_side=None):
         height, width = img.shape[:2]
+        if not max_side or max(height, width) <= max_side:
+            return img, 1.0
+        scale = max_side / max(height, width)
+        small = cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                           interpolation=cv2.INTER_AREA)
+        return small, scale
+
+    # 把整组结果的人脸框从缩小图换算回原图坐标（原地修改并返回 objs）
+    def scale_objs(objs, scale):
+        if scale != 1.0:
+            for obj in objs:
+                obj['region'] = deepAnalysis.scale_region(obj['region'], scale)
+        return objs
 
-        # 创建布局 - 左侧原图，右侧两列信息
-        info_width = 400  # 信息区域宽度
-        new_height = max(height, 400)  # 确保足够的高度
-        combined_img = np.ones((new_height, width + info_width, 3), dtype=np.uint8) * 255  # 白色背景
-
-        # 将带有人脸框的图放在左侧 - 确保尺寸匹配
-        combined_img[:height, :width] = img_with_box
-
-        # 提取需要显示的信息
-        age = face_data['age']
-        gender = face_data['dominant_gender']
-        race = face_data['dominant_race']
-        emotion = face_data['dominant_emotion']
-        emotions = face_data['emotion']
-
-        # 设置文本参数
-        font = cv2.FONT_HERSHEY_SIMPLEX
-        font_scale = 1
-        color = (0, 0, 0)  # 黑色
-        thickness = 2
-        line_height = 30
-
-        # 绘制分隔线
-        cv2.line(combined_img, (width, 0), (width, new_height), (200, 200, 200), 1)
-
-        # 第一列：基本信息
-        col1_x = width + 20
-        y_pos = 40
-
-        # 绘制标题
-        cv2.putText(combined_img, "Basic Information", (col1_x, int(y_pos)), font, font_scale, color, thickness)
-        y_pos += line_height * 1
-
-        # 基本信息
-        # cv2.putText(combined_img, f"Age: {age}", (col1_x, int(y_pos)), font, font_scale, color, thickness)
-        # y_pos += line_height
-        cv2.putText(combined_img, f"Gender: {gender}", (col1_x, int(y_pos)), font, font_scale, color, thickness)
-        y_pos += line_height
-        # cv2.putText(combined_img, f"Race: {race}", (col1_x, int(y_pos)), font, font_scale, color, thickness)
-        # y_pos += line_height
-        cv2.putText(combined_img, f"Emotion: {emotion}", (col1_x, int(y_pos)), font, font_scale, color, thickness)
-        y_pos += line_height * 1.5
-
-        # 第二列：情绪概率
-        # 绘制标题
-        cv2.putText(combined_img, "Emotion Probabilities", (col1_x, int(y_pos)), font, font_scale, color, thickness)
-        y_pos += line_height * 1
-
-        # 情绪概率列表
-        for emo, prob in emotions.items():
-            # 处理 np.float32 类型
-            if hasattr(prob, 'item'):
-                prob_value = prob.item()
+    # 把缩小图上的人脸框（含眼睛坐标）换算回原图坐标
+    def scale_region(region, scale):
+        if scale == 1.0:
+            return region
+        mapped = {}
+        for key, value in region.items():
+            if key in ('x', 'y', 'w', 'h'):
+                mapped[key] = int(round(value / scale))
+            elif isinstance(value, (tuple, list)):
+                mapped[key] = tuple(int(round(v / scale)) for v in value)
             else:
-                prob_value = prob
+                mapped[key] = value
+        return mapped
+
+    # 批量属性推理：把多张人脸叠成一个 batch，每个属性模型只做一次前向计算，
+    # 返回与 DeepFace.analyze 相同结构的结果列表（数值为 Python 内置类型）
+    def predict_batch(face_objs, actions=DEFAULT_PROFILE, timer=None, known=None, engine=DEFAULT_ENGINE):
+        return deepAnalysis.predict_arrays(face_objs, actions, timer=timer, known=known, engine=engine).to_objs()
+
+    # 与 predict_batch 相同，但返回按列存放的 faceResults，预测结果直接写入各属性矩阵；
+    # known 为与 face_objs 对应的已知属性（或 None），其中已有的 SUBJECT_ATTRIBUTES 不再推理；
+    # engine 支持的属性不加载 Keras 模型（ONNX 模型还没有转换时才会加载一次用于转换）
+    def predict_arrays(face_objs, actions=DEFAULT_PROFILE, timer=None, known=None, engine=DEFAULT_ENGINE):
+        actions = deepAnalysis.resolve_actions(actions)
+        timer = timer or stageTimer(registry=None)
+        keras_actions = [action for action in actions if not onnxEngine.supports(engine, action)]
+        models = dict(zip(keras_actions, modelRegistry.load(keras_actions, detector_backend=None)))
+        if known is None:
+            face_objs = [face for face in face_objs if face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+            known = [None] * len(face_objs)
+
+        results = faceResults.empty(len(face_objs), actions)
+        if not face_objs:
+            return results
+        results.boxes[:] = [[face['facial_area'][key] for key in ('x', 'y', 'w', 'h')] for face in face_objs]
+        results.confidence[:] = [face['confidence'] for face in face_objs]
+
+        # 与 DeepFace 相同的预处理：RGB 转 BGR，再等比缩放并填充到 224x224
+        with timer.span('preprocess'):
+            batch = np.concatenate([
+                preprocessing.resize_image(img=face['face'][:, :, ::-1], target_size=(224, 224))
+                for face in face_objs
+            ]).astype(np.float32)
+
+        for action in actions:
+            keys = SUBJECT_ATTRIBUTES.get(action)
+            target = getattr(results, action)
+            rows = []
+            for i, attributes in enumerate(known):
+                if keys and attributes is not None and all(key in attributes for key in keys):
+                    labels = PROBABILITY_FIELDS.get(action)
+                    target[i] = [attributes[action][label] for label in labels] if labels else attributes[action]
+                else:
+                    rows.append(i)
+            if not rows:
+                continue
+            with timer.span(f"infer_{action}"):
+                if len(rows) == len(face_objs):
+                    target[:] = deepAnalysis.predict_action(action, models.get(action), batch, engine)
+                else:
+                    target[rows] = deepAnalysis.predict_action(action, models.get(action), batch[rows], engine)
+        return results
+
+    # 人脸特征向量（L2 归一化，float32，形状为 人脸数 x 维度），一次前向计算整批人脸
+    def embed_faces(face_objs, model_name=DEFAULT_RECOGNIZER):
+        model = modelRegistry.load_recognizer(model_name)
+        if not face_objs:
+            return np.zeros((0, model.output_shape), dtype=np.float32)
+        # 与 DeepFace.represent 相同的预处理：RGB 转 BGR 后缩放到模型输入尺寸（input_shape 为高、宽）
+        target_size = (model.input_shape[1], model.input_shape[0])
+        batch = np.concatenate([
+            preprocessing.resize_image(img=face['face'][:, :, ::-1], target_size=target_size)
+            for face in face_objs
+        ]).astype(np.float32)
+        embeddings = np.asarray(model.model.predict(batch, verbose=0), dtype=np.float32)
+        return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+    # 单个属性模型对整个 batch 做一次前向计算：情绪、性别、人种返回百分比矩阵（列顺序见 PROBABILITY_FIELDS），年龄返回一维数组；
+    # engine 支持该属性时用 ONNX 会话推理（model 可以为 None），预处理和后处理与 Keras 模型完全相同
+    def predict_action(action, model, batch, engine=DEFAULT_ENGINE):
+        if onnxEngine.supports(engine, action):
+            def predict(inputs):
+                return onnxEngine.predict(action, inputs, engine,
+                                          source=lambda: modelRegistry.load([action], detector_backend=None)[0].model)
+        else:
+            def predict(inputs):
+                return model.model.predict(inputs, verbose=0)
+
+        if action == 'emotion':
+            gray = np.stack([cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (48, 48)) for img in batch])
+            predictions = predict(gray[..., np.newaxis])
+            return 100 * predictions / predictions.sum(axis=1, keepdims=True)
+        if action == 'age':
+            predictions = predict(batch)
+            return predictions @ np.arange(predictions.shape[1])
+        if action == 'gender':
+            return 100 * predict(batch)
+        if action == 'race':
+            predictions = predict(batch)
+            return 100 * predictions / predictions.sum(axis=1, keepdims=True)
+        raise ValueError(f"不支持的分析动作: {action}")
+
+    # 把结果中的 numpy 数值转换为 Python 内置类型，便于写入 JSON / CSV
+    def to_builtin(value):
+        if isinstance(value, dict):
+            return {key: deepAnalysis.to_builtin(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [deepAnalysis.to_builtin(item) for item in value]
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
+
+    # 读取原始图片（整条流水线只解码这一次）
+    def read_img(img_path):
+        img, _ = deepAnalysis.read_img_bytes(img_path)
+        return img
+
+    # 读取文件字节并解码，字节同时用于计算缓存键，避免为了哈希再读一次文件
+    def read_img_bytes(img_path):
+        with open(img_path, 'rb') as f:
+            data = f.read()
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        # 读取失败时抛出异常交给调用方处理（原来直接 exit()，在工作线程里会结束整个进程）
+        if img is None:
+            raise ValueError(f"无法读取图片: {img_path}")
+        return img, data
+
+    # 预处理：解码并把图片限制在 max_side（最长边）以内，返回 (图片, 缩放比例)，比例为处理后 / 原图尺寸。
+    # JPEG 直接在解码时按 1/2、1/4、1/8 缩小（libjpeg 的 DCT 缩放，比完整解码后再缩小快得多，也不会先分配整张大图），
+    # 剩下的部分和其他格式再用 INTER_AREA 缩小；缩小后只要不低于 REDUCED_DECODE_MIN × max_side 就直接按缩小解码，
+    # 例如 12MP 手机照片（4032×3024）在 max_side=2048 时按 1/2 解码为 2016×1512，而不是完整解码后再缩小；
+    # EXIF 方向由 OpenCV 在解码时应用（没有使用 IMREAD_IGNORE_ORIENTATION），两条路径得到的朝向一致。timer 中分别记录 decode 和 resize 的耗时
+    def decode_img(data, max_side=None, timer=None):
+        timer = timer or stageTimer()
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        flag = cv2.IMREAD_COLOR
+        size = deepAnalysis.jpeg_size(data) if max_side else None
+        if size:
+            for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                                    (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                if max(size) / factor >= REDUCED_DECODE_MIN * max_side:
+                    flag = reduced
+                    break
+        with timer.span('decode'):
+            img = cv2.imdecode(buffer, flag)
+        if img is None:
+            raise ValueError("无法解码图片")
+
+        scale = max(img.shape[:2]) / max(size) if size else 1.0
+        if max_side and max(img.shape[:2]) > max_side:
+            with timer.span('resize'):
+                img, resize_scale = deepAnalysis.downscale(img, max_side)
+            scale *= resize_scale
+        if flag != cv2.IMREAD_COLOR:
+            metrics.inc('reduced_decodes')
+        return img, scale
+
+    # 从 JPEG 的 SOF 段读出原图尺寸 (宽, 高)，不解码像素；不是 JPEG 或解析失败时返回 None
+    def jpeg_size(data):
+        if data[:2] != b'\xff\xd8':
+            return None
+        pos = 2
+        while pos + 9 <= len(data):
+            if data[pos] != 0xFF:
+                return None
+            marker = data[pos + 1]
+            if marker == 0xFF:  # 填充字节
+                pos += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD7:  # 没有长度字段的标记
+                pos += 2
+                continue
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height = int.from_bytes(data[pos + 5:pos + 7], 'big')
+                width = int.from_bytes(data[pos + 7:pos + 9], 'big')
+                return (width, height) if width and height else None
+            pos += 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+        return None
+
+    # 在原图副本上绘制所有人脸框，返回带框的图片（无论多少张人脸都只复制一次）；
+    # 人脸框统一是原图坐标，img 是预处理缩小过的图片时传入缩放比例 scale
+    def draw_red_box(img, objs, scale=1.0):
+        img_with_box = img.copy()
+        # 大图上按尺寸加粗边框，保证缩放显示后仍然可见
+        box_thickness = max(2, round(max(img.shape[:2]) / 600))
+
+        # 多张人脸时在框上方标出序号，与信息区的 Face #n 对应
+        numbered = len(objs) > 1
+        for index, face_data in enumerate(objs):
+            region = face_data['region']
+            x, y, w, h = (int(round(region[key] * scale)) for key in ('x', 'y', 'w', 'h'))
+            cv2.rectangle(img_with_box, (x, y), (x + w, y + h), (0, 0, 255), box_thickness)  # 红色边框
+            if numbered:
+                cv2.putText(img_with_box, f"#{index + 1}", (x, max(y - 6, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5,
+                            (0, 0, 255), 1)
+        return img_with_box
 
-            cv2.putText(combined_img, f"{emo}: {prob_value:.2f}%", (col1_x, int(y_pos)), font, font_scale, color,
-                        thickness)
-            y_pos += line_height
+    # 读取原始图片
+    def plot_Ana_img(img_path, objs, img_with_box=None):
+        if img_with_box is None:
+            img = deepAnalysis.read_img(img_path)
+            # 创建原图的副本，以保留原图
+            img_with_box = deepAnalysis.draw_red_box(img, objs)
+
+        combined_img = deepAnalysis.draw_Ana_img(img_with_box, objs)
 
         # 智能处理输出路径
         base_name, ext = os.path.splitext(img_path)
@@ -100,20 +332,94 @@ class deepAnalysis:
         cv2.imwrite(output_path, combined_img)
         return combined_img, output_path
 
-    def plot_red_box(or_img_path, objs):
-        img = cv2.imread(or_img_path)
-        if img is None:
-            print(f"无法读取图片: {or_img_path}")
-            exit()
+    # 单张人脸在信息区显示的文本行，index 不为 None 时使用多人脸的紧凑排版；
+    # 每行为 ([(x 偏移, 静态标签, 动态值), ...], 行高倍数)：标签画在缓存的模板上，每次只画动态值
+    def face_info_lines(face_data, index=None):
+        gender = face_data.get('dominant_gender')
+        emotion = face_data.get('dominant_emotion')
+        emotions = list(face_data.get('emotion', {}).items())
+
+        lines = [([(0, "Basic Information" if index is None else f"Face #{index + 1}", "")], 1)]
+        if face_data.get('identity') is not None:
+            lines.append(([(0, "Identity: ", face_data['identity'])], 1))
+        # lines.append(([(0, "Age: ", str(face_data['age']))], 1))
+        if gender is not None:
+            lines.append(([(0, "Gender: ", gender)], 1))
+        # lines.append(([(0, "Race: ", face_data['dominant_race'])], 1))
+        if emotion is not None:
+            lines.append(([(0, "Emotion: ", emotion)], 1))
+
+        if index is None:
+            lines.append(([], 0.5))
+            lines.append(([(0, "Emotion Probabilities", "")], 1))
+            lines += [([(0, f"{emo}: ", f"{float(prob):.2f}%")], 1) for emo, prob in emotions]
+        else:
+            # 紧凑排版：每行两个情绪概率
+            for i in range(0, len(emotions), 2):
+                lines.append(([(190 * j, f"{emo}: ", f"{float(prob):.1f}%")
+                               for j, (emo, prob) in enumerate(emotions[i:i + 2])], 1))
+            lines.append(([], 0.5))
+        return lines
+
+    # 把带框的图片和分析信息拼接成一张图（不读写磁盘）；
+    # 每张人脸一个信息块，一列放不下时向右新增一列。
+    # 静态标签来自按布局缓存的信息面板模板（与图片尺寸无关），每次只填白底、贴上模板和原图，再画动态数值；
+    # out 为形状相同的数组时直接写入其中（批量场景每个线程复用同一块缓冲区），否则新分配
+    def draw_Ana_img(img_with_box, objs, out=None):
+        # 获取图片尺寸
+        height, width = img_with_box.shape[:2]
 
-        # 创建原图的副本
-        img_with_box = img.copy()
+        # 多张人脸时使用小字号
+        compact = len(objs) > 1
+        new_height = max(height, 400)  # 确保足够的高度
+
+        blocks = [deepAnalysis.face_info_lines(face_data, index if compact else None)
+                  for index, face_data in enumerate(objs)]
+        line_height = OVERLAY_STYLE[compact][2]
+        columns = [[]]
+        y_pos = OVERLAY_TOP
+        for block in blocks:
+            block_height = sum(step for _, step in block) * line_height
+            if columns[-1] and y_pos + block_height > new_height:
+                columns.append([])
+                y_pos = OVERLAY_TOP
+            columns[-1].append(block)
+            y_pos += block_height
+
+        # 布局只包含静态部分（标签、偏移和行高），相同布局的图片共用一个模板
+        layout = tuple(tuple(tuple((tuple((dx, label) for dx, label, _ in segments), step) for segments, step in block)
+                             for block in column) for column in columns)
+        shape = (new_height, width + OVERLAY_COLUMN_WIDTH * len(columns), 3)
+        panel, positions = overlayTemplates.get((compact, layout))
+
+        if out is not None and out.shape == shape and out.dtype == np.uint8:
+            combined_img = out
+        else:
+            combined_img = np.empty(shape, dtype=np.uint8)
 
-        # 在人脸上绘制边框
-        face_data = objs[0]
-        region = face_data['region']
-        x, y, w, h = region['x'], region['y'], region['w'], region['h']
-        cv2.rectangle(img_with_box, (x, y), (x + w, y + h), (0, 0, 255), 2)  # 红色边框
+        # 将带有人脸框的图放在左侧，下方不足的部分和右侧信息区填白色
+        combined_img[:height, :width] = img_with_box
+        combined_img[height:, :width] = 255
+        combined_img[:, width:] = 255
+        rows = min(panel.shape[0], new_height)
+        combined_img[:rows, width:] = panel[:rows]
+        combined_img[:, width] = 200  # 分隔线
+
+        font_scale, thickness, _ = OVERLAY_STYLE[compact]
+        values = [value for column in columns for block in column for segments, _ in block
+                  for _, _, value in segments]
+        for (x, y), value in zip(positions, values):
+            if value:
+                cv2.putText(combined_img, value, (width + x, y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, OVERLAY_COLOR,
+                            thickness)
+
+        return combined_img
+
+    def plot_red_box(or_img_path, objs, img_with_box=None):
+        if img_with_box is None:
+            img = deepAnalysis.read_img(or_img_path)
+            # 创建原图的副本并在人脸上绘制边框
+            img_with_box = deepAnalysis.draw_red_box(img, objs)
 
         # 智能处理输出路径
         base_name, ext = os.path.splitext(or_img_path)
@@ -125,39 +431,369 @@ class deepAnalysis:
     def save_img(combined_img_path):
         print(f"分析结果已保存至: {combined_img_path}!")
 
-    def parse_deepface_result(result_list):
-        result = result_list[0]
-
-        # 整理 summary 信息
-        summary = {
-            '年龄': result.get('age', 'N/A'),
-            '性别': result.get('dominant_gender', 'N/A'),
-            '人种': result.get('dominant_race', 'N/A'),
-            '情感': result.get('dominant_emotion', 'N/A'),
-        }
-        summary_text = "Result:\n" + "\n".join([f"{key}: {value}" for key, value in summary.items()])
-
-        # 整理情绪概率信息
-        emotions = result.get('emotion', {})
-        if emotions:
-            emotion_lines = [f"{emotion.title():<10}: {float(prob):.2f}%" for emotion, prob in emotions.items()]
-            emotion_text = "各情绪概率:\n" + "\n".join(emotion_lines)
+    # 按扩展名选择编码格式写盘，quality 对 JPEG / WebP 有效；
+    # 使用 imencode + tofile，路径中含中文时也能正常保存
+    def write_img(output_path, img, quality=95):
+        ext = os.path.splitext(output_path)[1].lower() or '.png'
+        deepAnalysis.encode_img(img, ext, quality).tofile(output_path)
+        return output_path
+
+    # 按格式编码为内存中的字节（numpy 数组），JPEG / WebP 使用 quality，PNG 使用较快的压缩级别
+    def encode_img(img, ext='.png', quality=95):
+        if ext in ('.jpg', '.jpeg'):
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+        elif ext == '.webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+        elif ext == '.png':
+            params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
         else:
-            emotion_text = "Emotion Probabilities:\nN/A"
+            params = []
 
-        return summary_text, emotion_text
+        start = time.perf_counter()
+        ok, buffer = cv2.imencode(ext, img, params)
+        metrics.observe('stage_encode_ms', 1000 * (time.perf_counter() - start))
+        if not ok:
+            raise ValueError(f"无法编码为 {ext} 图片")
+        return buffer
 
+    def parse_deepface_result(result_list):
+        # 整理 summary 信息（只列出本次实际分析过的属性）
+        fields = [('身份', 'identity'), ('年龄', 'age'), ('性别', 'dominant_gender'), ('人种', 'dominant_race'),
+                  ('情感', 'dominant_emotion')]
+        multi = len(result_list) > 1
+
+        summary_lines = ["Result:"]
+        emotion_blocks = []
+        for index, result in enumerate(result_list):
+            summary = {label: result[key] for label, key in fields if key in result}
+            if multi:
+                summary_lines.append(f"人脸 {index + 1}:")
+            summary_lines += [f"{key}: {value}" for key, value in summary.items()]
+
+            # 整理情绪概率信息
+            emotions = result.get('emotion', {})
+            title = f"人脸 {index + 1} 各情绪概率:" if multi else "各情绪概率:"
+            if emotions:
+                emotion_lines = [f"{emotion.title():<10}: {float(prob):.2f}%" for emotion, prob in emotions.items()]
+                emotion_blocks.append(title + "\n" + "\n".join(emotion_lines))
+            else:
+                emotion_blocks.append("Emotion Probabilities:\nN/A")
 
-def Analysis(or_img_path):
-    objs = deepAnalysis.Analysis(or_img_path)
-    summary, emotion_text = deepAnalysis.parse_deepface_result(objs)
+        summary_text = "\n".join(summary_lines)
+        emotion_text = "\n\n".join(emotion_blocks)
+        return summary_text, emotion_text
 
-    _, redboxoutput_path = deepAnalysis.plot_red_box(or_img_path, objs)
-    _, combined_img_path = deepAnalysis.plot_Ana_img(or_img_path, objs)
 
-    return summary, emotion_text, redboxoutput_path, combined_img_path
+# 信息面板模板缓存：只缓存右侧信息区中有文字的部分（白底 + 所有静态标签），按字号和布局只绘制一次，
+# 与图片尺寸无关，不同尺寸的图片只要人脸数和属性相同就共用一个模板；
+# 同时记下每个动态值相对信息区左上角的绘制位置；模板只读，直接贴进结果图
+class overlayTemplates:
+    lock = threading.Lock()
+    templates = OrderedDict()
+    max_entries = 64  # 模板只有文字区域大小（几百 KB），可以多保留一些布局
+
+    def get(key):
+        with overlayTemplates.lock:
+            if key in overlayTemplates.templates:
+                overlayTemplates.templates.move_to_end(key)
+                metrics.inc('overlay_template_hits')
+                return overlayTemplates.templates[key]
+
+        entry = overlayTemplates.build(*key)
+        metrics.inc('overlay_template_builds')
+        with overlayTemplates.lock:
+            overlayTemplates.templates[key] = entry
+            while len(overlayTemplates.templates) > overlayTemplates.max_entries:
+                overlayTemplates.templates.popitem(last=False)
+        return entry
+
+    def build(compact, layout):
+        font = cv2.FONT_HERSHEY_SIMPLEX
+        font_scale, thickness, line_height = OVERLAY_STYLE[compact]
+        # 高度取最长一列文字的末尾（再留一行给字母下沿）
+        height = OVERLAY_TOP + line_height * (1 + max(sum(step for block in column for _, step in block)
+                                                      for column in layout))
+        template = np.full((int(height), OVERLAY_COLUMN_WIDTH * len(layout), 3), 255, dtype=np.uint8)  # 白色背景
+
+        positions = []
+        for col, column in enumerate(layout):
+            col_x = 20 + col * OVERLAY_COLUMN_WIDTH
+            y_pos = OVERLAY_TOP
+            for block in column:
+                for segments, step in block:
+                    for dx, label in segments:
+                        cv2.putText(template, label, (col_x + dx, int(y_pos)), font, font_scale, OVERLAY_COLOR,
+                                    thickness)
+                        # 动态值紧跟在标签之后，与整行一起绘制时的位置相同
+                        label_width = cv2.getTextSize(label, font, font_scale, thickness)[0][0]
+                        positions.append((col_x + dx + label_width, int(y_pos)))
+                    y_pos += line_height * step
+
+        template.setflags(write=False)
+        return template, positions
+
+
+# 模型注册表：启动时一次性加载所选动作的模型，并用假图片做一次预热推理，
+# 让第一次点击“开始检测”不再承担权重加载和计算图构建的冷启动开销
+class modelRegistry:
+    lock = threading.Lock()
+    loaded = {}  # 动作 -> 模型对象
+    warmed = set()  # 已经预热过的动作
+    timings = {}  # 各阶段耗时（秒），如 'load_emotion'、'warmup'
+
+    def load(actions=DEFAULT_PROFILE, detector_backend=DEFAULT_DETECTOR):
+        # actions 为空列表时只加载检测器，detector_backend 为 None 时只加载属性模型
+        actions = deepAnalysis.resolve_actions(actions) if actions else []
+        with modelRegistry.lock:
+            if detector_backend is not None and detector_backend not in modelRegistry.loaded:
+                start = time.perf_counter()
+                modelRegistry.loaded[detector_backend] = DeepFace.build_model(model_name=detector_backend,
+                                                                             task="face_detector")
+                modelRegistry.timings[f"load_{detector_backend}"] = time.perf_counter() - start
+
+            for action in actions:
+                if action in modelRegistry.loaded:
+                    continue
+                start = time.perf_counter()
+                modelRegistry.loaded[action] = DeepFace.build_model(model_name=ACTION_MODELS[action],
+                                                                   task="facial_attribute")
+                modelRegistry.timings[f"load_{action}"] = time.perf_counter() - start
+
+        return [modelRegistry.loaded[action] for action in actions]
+
+    # 人脸识别（特征提取）模型，供身份索引使用
+    def load_recognizer(model_name=DEFAULT_RECOGNIZER):
+        key = f"recognition_{model_name}"
+        with modelRegistry.lock:
+            if key not in modelRegistry.loaded:
+                start = time.perf_counter()
+                modelRegistry.loaded[key] = DeepFace.build_model(model_name=model_name, task="facial_recognition")
+                modelRegistry.timings[f"load_{key}"] = time.perf_counter() - start
+        return modelRegistry.loaded[key]
+
+    # 用一张空白假图跑一次完整推理，触发计算图构建
+    def warm_up(actions=DEFAULT_PROFILE, detector_backend=DEFAULT_DETECTOR):
+        actions = deepAnalysis.resolve_actions(actions)
+        modelRegistry.load(actions, detector_backend=detector_backend)
+        pending = [action for action in actions if action not in modelRegistry.warmed]
+        if not pending:
+            return
+
+        dummy = np.zeros((224, 224, 3), dtype=np.uint8)
+        start = time.perf_counter()
+        # 假图中没有人脸，关闭 enforce_detection 让 DeepFace 直接把整张图当作人脸
+        DeepFace.analyze(img_path=dummy, actions=pending, detector_backend=detector_backend, enforce_detection=False,
+                         silent=True)
+        modelRegistry.timings['warmup'] = modelRegistry.timings.get('warmup', 0.0) + time.perf_counter() - start
+        with modelRegistry.lock:
+            modelRegistry.warmed.update(pending)
+
+    def is_ready(actions=DEFAULT_PROFILE, detector_backend=DEFAULT_DETECTOR):
+        actions = deepAnalysis.resolve_actions(actions)
+        return detector_backend in modelRegistry.loaded and all(
+            action in modelRegistry.warmed for action in actions)
+
+    # 加载 + 预热，返回本次涉及的耗时信息，供界面显示
+    def preload(actions=DEFAULT_PROFILE, detector_backend=DEFAULT_DETECTOR):
+        actions = deepAnalysis.resolve_actions(actions)
+        modelRegistry.warm_up(actions, detector_backend=detector_backend)
+        keys = [f"load_{detector_backend}"] + [f"load_{action}" for action in actions] + ['warmup']
+        return {key: modelRegistry.timings[key] for key in keys if key in modelRegistry.timings}
+
+    # 在后台线程中预加载，callback(timings, error) 在加载结束后调用
+    def preload_async(actions=DEFAULT_PROFILE, callback=None, detector_backend=DEFAULT_DETECTOR):
+        def run():
+            try:
+                timings = modelRegistry.preload(actions, detector_backend=detector_backend)
+            except Exception as e:
+                if callback:
+                    callback(None, e)
+                return
+            if callback:
+                callback(timings, None)
+
+        thread = threading.Thread(target=run, name="model-preload", daemon=True)
+        thread.start()
+        return thread
+
+    def timing_text(timings=None):
+        timings = modelRegistry.timings if timings is None else timings
+        return ", ".join(f"{key}: {value:.2f}s" for key, value in timings.items())
+
+
+# 单次解码的分析流水线：图片只解码一次，同一个数组依次交给 DeepFace 和两个渲染函数，
+# 带框图只复制一次，同时用作红框结果和拼接图的左半部分
+# cache 为 True 时使用默认缓存，也可以传入自己的 resultCache，传 None 则不使用缓存；
+# progress(stage, percent) 在每个阶段开始时调用，可以在其中抛出 AnalysisCancelled 取消分析；
+# 结果中的 timings 为各阶段耗时（毫秒），profile=True 时 result['profile'] 为本次调用的 cProfile 统计；
+# 传入 index 时查找人脸身份，身份会随索引内容变化，因此不使用结果缓存；
+# 传入 objs（之前的分析结果）时不检测也不推理，只重新解码和绘制结果图；
+# max_side 为分析分辨率上限：图片在预处理阶段缩小（JPEG 在解码时直接缩小，见 decode_img），检测、推理和结果图都基于缩小后的图片，
+# 而 objs 中的人脸框始终是原图坐标，result['scale'] 为结果图相对原图的缩放比例；engine 为属性模型的推理引擎；
+# img 可以是解码后的 BGR 数组，也可以是编码后的图片字节（按文件内容处理）；render=False 时不绘制结果图，两张结果图为 None
+def AnalysisPipeline(or_img_path=None, img=None, actions=DEFAULT_PROFILE, cache=True, progress=None,
+                     detector_backend=DEFAULT_DETECTOR, align=True, detect_max_side=None, profile=False, index=None,
+                     objs=None, max_side=None, engine=DEFAULT_ENGINE, render=True):
+    actions = deepAnalysis.resolve_actions(actions)
+    cache = resultCache.default() if cache is True else cache
+    if index is not None:
+        cache = None
+    progress = progress or (lambda stage, percent: None)
+    timer = stageTimer()
+    start = time.perf_counter()
+    metrics.inc('analyses_total')
+
+    try:
+        with profiled(profile) as profile_report:
+            progress('decode', 0)
+            data = img
+            scale = 1.0
+            if isinstance(img, (bytes, bytearray, memoryview)):
+                data = bytes(img)
+                img, scale = deepAnalysis.decode_img(data, max_side, timer)
+            elif img is None:
+                with timer.span('decode'):
+                    with open(or_img_path, 'rb') as f:
+                        data = f.read()
+                img, scale = deepAnalysis.decode_img(data, max_side, timer)
+            elif max_side:
+                with timer.span('resize'):
+                    img, scale = deepAnalysis.downscale(img, max_side)
+
+            progress('inference', 10)
+
+            # 命中缓存时直接返回之前的分析结果，不会触碰模型
+            if objs is None and cache:
+                with timer.span('cache'):
+                    key = cache.make_key(data, actions, deepface.__version__, detector_backend, align,
+                                         detect_max_side, max_side, engine)
+                    objs = cache.get(key)
+                metrics.inc('cache_hits' if objs is not None else 'cache_misses')
+            cached = objs is not None
+            if not cached:
+                objs = deepAnalysis.Analysis(img, actions=actions, detector_backend=detector_backend, align=align,
+                                             detect_max_side=detect_max_side, timer=timer, index=index, engine=engine)
+                deepAnalysis.scale_objs(objs, scale)
+                if cache:
+                    cache.put(key, deepAnalysis.to_builtin(objs))
+
+            progress('render', 80)
+            with timer.span('parse'):
+                summary, emotion_text = deepAnalysis.parse_deepface_result(objs)
+
+            img_with_box = combined_img = None
+            if render:
+                with timer.span('render'):
+                    img_with_box = deepAnalysis.draw_red_box(img, objs, scale)
+                    combined_img = deepAnalysis.draw_Ana_img(img_with_box, objs)
+    except AnalysisCancelled:
+        metrics.inc('analyses_cancelled')
+        raise
+    except Exception:
+        metrics.inc('analysis_errors')
+        raise
+
+    total_ms = 1000 * (time.perf_counter() - start)
+    metrics.observe('analysis_total_ms', total_ms)
+    metrics.inc('faces_total', len(objs))
+    timer.spans['total'] = total_ms
+
+    progress('done', 100)
+    return {
+        'objs': objs,
+        'summary': summary,
+        'emotion_text': emotion_text,
+        'redbox_img': img_with_box,
+        'combined_img': combined_img,
+        'cached': cached,
+        'scale': scale,
+        'timings': timer.spans,
+        'profile': profile_report.get('text'),
+    }
+
+
+# 保存流水线的结果图：拼接图写到 output_path，红框图写到同目录的 *_redbox 文件
+def SaveResult(result, output_path, quality=95):
+    base_name, ext = os.path.splitext(output_path)
+    redbox_path = f"{base_name}_redbox{ext or '.png'}"
+    deepAnalysis.write_img(redbox_path, result['redbox_img'], quality)
+    deepAnalysis.write_img(output_path, result['combined_img'], quality)
+    return redbox_path, output_path
+
+
+# 命令行 / 旧接口：分析后把结果图写到原图旁边，返回显示文本和文件路径
+def Analysis(or_img_path, actions=DEFAULT_PROFILE, progress=None, detector_backend=DEFAULT_DETECTOR, align=True,
+             detect_max_side=None, profile=False, max_side=None, engine=DEFAULT_ENGINE):
+    result = AnalysisPipeline(or_img_path, actions=actions, progress=progress, detector_backend=detector_backend,
+                              align=align, detect_max_side=detect_max_side, profile=profile, max_side=max_side,
+                              engine=engine)
+    print(timings_text(result['timings']))
+    if result['profile']:
+        print(result['profile'])
+
+    # 复用流水线里已经画好的结果，只负责写盘
+    base_name, ext = os.path.splitext(or_img_path)
+    redboxoutput_path = f"{base_name}_redbox{ext}"
+    combined_img_path = f"{base_name}_analyzed{ext}"
+    deepAnalysis.write_img(redboxoutput_path, result['redbox_img'])
+    deepAnalysis.write_img(combined_img_path, result['combined_img'])
+
+    return result['summary'], result['emotion_text'], redboxoutput_path, combined_img_path
+
+
+# 对比各检测后端在同一批图片上的耗时和检出人脸数，用来按部署环境选择检测器
+def DetectorBenchmark(img_paths, backends=DETECTOR_BACKENDS, align=True, detect_max_side=None, repeat=3):
+    imgs = [deepAnalysis.read_img(path) for path in img_paths]
+    report = {}
+    for backend in backends:
+        try:
+            modelRegistry.load([], detector_backend=backend)
+            deepAnalysis.detect_faces(imgs[0], backend, align, detect_max_side)  # 预热
+        except Exception as e:
+            report[backend] = {'error': str(e)}
+            continue
+
+        seconds, faces = [], 0
+        for _ in range(repeat):
+            faces = 0
+            for img in imgs:
+                start = time.perf_counter()
+                face_objs = deepAnalysis.detect_faces(img, backend, align, detect_max_side)
+                seconds.append(time.perf_counter() - start)
+                # 没有检测到人脸时返回的整图置信度为 0，不计入
+                faces += sum(1 for face in face_objs if face['confidence'])
+        report[backend] = {
+            'mean_ms': 1000 * float(np.mean(seconds)),
+            'p95_ms': 1000 * float(np.percentile(seconds, 95)),
+            'faces': faces,
+        }
+    return report
 
 
 if __name__ == "__main__":
-    or_emo_path = r"qqemo/emo2.png"
-    summary, emotion_text, redboxoutput_path, combined_img_path = Analysis(or_emo_path)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="单张图片表情分析")
+    parser.add_argument('image', nargs='?', default=r"qqemo/emo2.png")
+    parser.add_argument('--actions', default=DEFAULT_PROFILE, choices=list(ACTION_PROFILES))
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR, help="人脸检测后端")
+    parser.add_argument('--no-align', action='store_true', help="关闭人脸对齐")
+    parser.add_argument('--detect-max-side', type=int, help="检测前把图片缩小到的最长边")
+    parser.add_argument('--max-side', type=int, help="分析分辨率上限，大图在解码时就缩小，结果图也是这个尺寸")
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=INFERENCE_ENGINES,
+                        help="属性模型的推理引擎，onnx / onnx-int8 需要安装 onnxruntime")
+    parser.add_argument('--threads', type=int, help="ONNX 推理的 intra-op 线程数")
+    parser.add_argument('--bench-detectors', nargs='*', help="对比检测后端耗时（不指定则对比全部）")
+    parser.add_argument('--profile', action='store_true', help="用 cProfile 统计本次分析并打印结果")
+    args = parser.parse_args()
+
+    onnxEngine.configure(threads=args.threads)
+    if args.bench_detectors is not None:
+        for backend, stats in DetectorBenchmark([args.image], args.bench_detectors or DETECTOR_BACKENDS,
+                                                not args.no_align, args.detect_max_side).items():
+            print(backend, stats)
+    else:
+        or_emo_path = args.image
+        summary, emotion_text, redboxoutput_path, combined_img_path = Analysis(
+            or_emo_path, actions=args.actions, detector_backend=args.detector, align=not args.no_align,
+            detect_max_side=args.detect_max_side, profile=args.profile, max_side=args.max_side, engine=args.engine)
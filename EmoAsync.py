@@ -0,0 +1,166 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from EmoAna import AnalysisPipeline, AnalysisCancelled, modelRegistry, deepAnalysis
+from EmoMetrics import metrics
+from EmoOptions import DEFAULT_DETECTOR, DEFAULT_MAX_SIDE
+from EmoResults import faceResults
+
+# 异步分析接口：供基于 asyncio 的服务嵌入使用，例如
+#   async with asyncAnalyzer(max_concurrent=2) as analyzer:
+#       result = await analyzer.analyze(image_bytes, {'actions': 'emotion-only'}, timeout=10)
+# 解码、检测、推理和绘制都在执行器（默认为自带的线程池，也可以传入自己的线程池）中进行，不阻塞事件循环；
+# 信号量限制同时进行的分析数，大量并发请求在事件循环中排队，而不是同时挤占 CPU。
+# 超时或调用方取消时任务在下一个阶段边界中止（推理本身无法中断），中止前仍占用并发名额，因此不会超额占用 CPU
+
+
+# 同时进行的分析数默认值：检测和推理本身会用满多个核，并发过高只会互相争抢
+DEFAULT_CONCURRENCY = max(1, min(4, (os.cpu_count() or 1) // 2))
+
+
+# 一次分析的结构化结果
+#   faces         faceResults，人脸框为原图坐标
+#   summary / emotion_text  与界面一致的文字结果
+#   timings       各阶段耗时（毫秒），另有 wait 为排队等待并发名额的时间
+#   cached        是否命中结果缓存；scale 为分析分辨率相对原图的比例
+#   redbox_img / combined_img  render=True 时的结果图（BGR 数组），否则为 None
+class analysisResult:
+    def __init__(self, result):
+        self.faces = faceResults.from_objs(result['objs'])
+        self.summary = result['summary']
+        self.emotion_text = result['emotion_text']
+        self.timings = result['timings']
+        self.cached = result['cached']
+        self.scale = result['scale']
+        self.redbox_img = result['redbox_img']
+        self.combined_img = result['combined_img']
+
+    def __len__(self):
+        return len(self.faces)
+
+    # 可以直接 JSON 序列化的字典，faces 为 DeepFace 结构的字典列表
+    def to_dict(self):
+        return {
+            'faces': self.faces.to_objs(),
+            'summary': self.summary,
+            'emotion_text': self.emotion_text,
+            'timings': self.timings,
+            'cached': self.cached,
+            'scale': self.scale,
+        }
+
+
+# 异步分析器：可以在多个事件循环中使用（例如脚本、测试中多次 asyncio.run），每个事件循环各有一个信号量，
+# 并发上限按事件循环分别计算；executor 为执行分析的线程池，None 时创建 max_concurrent 个线程的线程池并在 close() 时关闭；
+# timeout 为默认超时（秒，包括排队时间），None 表示不限；defaults 为默认的 AnalysisPipeline 参数
+class asyncAnalyzer:
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, executor=None, max_concurrent=DEFAULT_CONCURRENCY, timeout=None, **defaults):
+        self.own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="emo-async")
+        self.max_concurrent = max_concurrent
+        self.timeout = timeout
+        self.defaults = {'detector_backend': DEFAULT_DETECTOR, 'max_side': DEFAULT_MAX_SIDE, **defaults}
+        self.semaphores = weakref.WeakKeyDictionary()  # 事件循环 -> 信号量，事件循环关闭回收后自动删除
+        self.lock = threading.Lock()
+
+    # 模块级 analyze() 使用的共享实例
+    @classmethod
+    def default(cls):
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    # 当前事件循环的信号量
+    def semaphore(self):
+        loop = asyncio.get_running_loop()
+        with self.lock:
+            semaphore = self.semaphores.get(loop)
+            if semaphore is None:
+                semaphore = self.semaphores[loop] = asyncio.Semaphore(self.max_concurrent)
+        return semaphore
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.own_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    # 在执行器中加载并预热模型，服务启动时调用，避免第一个请求承担加载时间
+    async def preload(self, actions='full', detector_backend=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, modelRegistry.preload, deepAnalysis.resolve_actions(actions),
+                                          detector_backend or self.defaults['detector_backend'])
+
+    # 分析一张图片，image 为图片路径、编码后的图片字节或 BGR 数组；options 为 AnalysisPipeline 的参数
+    # （actions、detector_backend、align、detect_max_side、max_side、engine、cache、render 等），覆盖默认参数。
+    # 返回 analysisResult；超时抛出 asyncio.TimeoutError，调用方取消时抛出 asyncio.CancelledError
+    async def analyze(self, image, options=None, timeout=None):
+        options = {'render': False, **self.defaults, **(options or {})}
+        timeout = self.timeout if timeout is None else timeout
+        try:
+            return await asyncio.wait_for(self.run(image, options), timeout)
+        except asyncio.TimeoutError:
+            metrics.inc('async_timeouts')
+            raise
+
+    # 同时分析多张图片，结果按输入顺序返回；return_exceptions=True 时单张失败不影响其它图片
+    async def analyze_many(self, images, options=None, timeout=None, return_exceptions=False):
+        return await asyncio.gather(*(self.analyze(image, options, timeout) for image in images),
+                                    return_exceptions=return_exceptions)
+
+    async def run(self, image, options):
+        loop = asyncio.get_running_loop()
+        semaphore = self.semaphore()
+        start = time.perf_counter()
+        await semaphore.acquire()
+        wait_ms = 1000 * (time.perf_counter() - start)
+        metrics.observe('async_wait_ms', wait_ms)
+
+        cancel = threading.Event()
+
+        def check(stage, percent):
+            if cancel.is_set():
+                raise AnalysisCancelled()
+
+        try:
+            if isinstance(image, (str, os.PathLike)):
+                future = loop.run_in_executor(self.executor, lambda: AnalysisPipeline(image, progress=check, **options))
+            else:
+                future = loop.run_in_executor(self.executor,
+                                              lambda: AnalysisPipeline(img=image, progress=check, **options))
+        except BaseException:
+            semaphore.release()
+            raise
+
+        # 并发名额在执行器中的任务真正结束时才释放，被取消的任务中止前不会让出 CPU
+        def finished(future):
+            semaphore.release()
+            if not future.cancelled():
+                future.exception()  # 调用方已经放弃的任务，异常不再报告
+        future.add_done_callback(finished)
+
+        try:
+            result = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            cancel.set()
+            metrics.inc('async_cancelled')
+            raise
+        result['timings']['wait'] = wait_ms
+        return analysisResult(result)
+
+
+# 使用共享的默认分析器（默认并发数、自带线程池）分析一张图片
+async def analyze(image, options=None, timeout=None):
+    return await asyncAnalyzer.default().analyze(image, options, timeout)
@@ -0,0 +1,251 @@
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from EmoAna import deepAnalysis, ACTION_PROFILES, DEFAULT_DETECTOR, EMOTION_LABELS
+from EmoResults import faceResults
+from EmoMetrics import metrics, stageTimer
+from EmoEngine import onnxEngine
+from EmoOptions import INFERENCE_ENGINES, DEFAULT_ENGINE, iter_images
+
+
+# 结果输出：按后缀选择 JSONL（每张图片一行）或 CSV（每张人脸一行），边算边写；
+# fmt='npy' 时 output_path 为目录，所有人脸按列保存为 .npy（faceResults.save），另有 image.npy 记录每张人脸属于哪张图片
+class resultWriter:
+    CSV_FIELDS = ['path', 'face', 'x', 'y', 'w', 'h', 'face_confidence', 'dominant_emotion'] + EMOTION_LABELS + \
+                 ['age', 'dominant_gender', 'dominant_race', 'identity', 'identity_distance', 'error']
+
+    def __init__(self, output_path, fmt=None):
+        self.fmt = fmt or ('csv' if output_path.lower().endswith('.csv') else 'jsonl')
+        self.output_path = output_path
+        self.file = None
+        self.csv = None
+        if self.fmt == 'npy':
+            self.parts, self.image_index, self.paths, self.errors = [], [], [], {}
+            return
+
+        self.file = sys.stdout if output_path == '-' else open(output_path, 'w', encoding='utf-8', newline='')
+        if self.fmt == 'csv':
+            self.csv = csv.DictWriter(self.file, fieldnames=self.CSV_FIELDS, extrasaction='ignore')
+            self.csv.writeheader()
+
+    # results 为这张图片的 faceResults
+    def write(self, path, results=None, error=None):
+        if self.fmt == 'npy':
+            if error:
+                self.errors[len(self.paths)] = error
+            if results is not None and len(results):
+                self.parts.append(results)
+                self.image_index.append(np.full(len(results), len(self.paths), dtype=np.int32))
+            self.paths.append(path)
+            return
+
+        objs = results.to_objs() if results is not None else []
+        if self.fmt == 'jsonl':
+            record = {'path': path, 'faces': objs}
+            if error:
+                record['error'] = error
+            self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            return
+
+        if error:
+            self.csv.writerow({'path': path, 'error': error})
+            return
+        if not objs:
+            # 没有人脸的图片也写一行（face 为空），与读取失败的图片区分开
+            self.csv.writerow({'path': path})
+            return
+        for index, obj in enumerate(objs):
+            row = {'path': path, 'face': index}
+            row.update(obj['region'])
+            row.update(obj.get('emotion', {}))
+            row.update({key: obj[key] for key in ('face_confidence', 'dominant_emotion', 'age', 'dominant_gender',
+                                                   'dominant_race', 'identity', 'identity_distance') if key in obj})
+            self.csv.writerow(row)
+
+    def close(self):
+        if self.fmt == 'npy':
+            faceResults.concat(self.parts).save(self.output_path)
+            image_index = np.concatenate(self.image_index) if self.image_index else np.zeros(0, dtype=np.int32)
+            np.save(os.path.join(self.output_path, 'image.npy'), image_index)
+            with open(os.path.join(self.output_path, 'images.json'), 'w', encoding='utf-8') as f:
+                json.dump({'paths': self.paths, 'errors': self.errors}, f, ensure_ascii=False)
+            return
+        self.file.flush()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+# 线程池任务：解码 + 人脸检测（OpenCV 在这些调用中会释放 GIL），每个线程各用一个 stageTimer；
+# max_side 不为空时按分析分辨率上限解码（见 deepAnalysis.decode_img），人脸框换算回原图坐标，
+# 返回 (图片, 图片相对原图的缩放比例, 人脸)；没有检测到人脸时 DeepFace 返回的整图区域（confidence 为 0）不算人脸，
+# 这样的图片结果为空列表
+def load_and_detect(path, detector_backend, align, detect_max_side, max_side=None):
+    timer = stageTimer()
+    with timer.span('decode'):
+        with open(path, 'rb') as f:
+            data = f.read()
+    try:
+        img, scale = deepAnalysis.decode_img(data, max_side, timer)
+    except ValueError:
+        raise ValueError(f"无法读取图片: {path}")
+    with timer.span('detect'):
+        faces = deepAnalysis.detect_faces(img, detector_backend=detector_backend, align=align,
+                                          detect_max_side=detect_max_side)
+    faces = [face for face in faces if face['confidence'] and face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+    for face in faces:
+        face['facial_area'] = deepAnalysis.scale_region(face['facial_area'], scale)
+    return img, scale, faces
+
+
+# 每个线程各自复用一块结果图缓冲区，图片尺寸相同时不再重复分配（结果图写盘后缓冲区即可复用）
+render_buffers = threading.local()
+
+
+# 线程池任务：绘制结果图并写盘
+def render(path, img, scale, objs, render_dir):
+    with stageTimer().span('render'):
+        img_with_box = deepAnalysis.draw_red_box(img, objs, scale)
+        combined_img = deepAnalysis.draw_Ana_img(img_with_box, objs, out=getattr(render_buffers, 'combined', None))
+        render_buffers.combined = combined_img
+    base_name, ext = os.path.splitext(os.path.basename(path))
+    cv2.imwrite(os.path.join(render_dir, f"{base_name}_analyzed{ext}"), combined_img)
+
+
+# 批量分析引擎：解码和检测在线程池中预取，多张图片的人脸攒成一个 batch 后统一推理，
+# 结果按输入顺序流式写出，内存中最多只保留 batch_size 张人脸及对应的图片（等待推理的图片数也不超过 batch_size）；
+# 传入 index（EmoIndex.faceIndex）时同一批人脸一起查询身份，已知人物的固定属性不再推理
+def BatchAnalysis(inputs, output_path, actions='emotion-only', batch_size=32, workers=4, fmt=None,
+                  render_dir=None, detector_backend=DEFAULT_DETECTOR, align=True, detect_max_side=None, index=None,
+                  max_side=None, engine=DEFAULT_ENGINE):
+    actions = deepAnalysis.resolve_actions(actions)
+    if render_dir:
+        os.makedirs(render_dir, exist_ok=True)
+
+    writer = resultWriter(output_path, fmt)
+    stats = {'images': 0, 'faces': 0, 'no_faces': 0, 'errors': 0}
+    timer = stageTimer()  # 只在主线程中使用：批量推理各模型的累计耗时
+    start = time.perf_counter()
+
+    pending = []  # (path, img, scale, faces) 等待批量推理
+    pending_faces = 0
+
+    def flush(pool, render_futures):
+        nonlocal pending, pending_faces
+        batch = [face for _, _, _, faces in pending for face in faces]
+        if index is None:
+            results = deepAnalysis.predict_arrays(batch, actions, timer=timer, engine=engine)
+        else:
+            with timer.span('identify'):
+                embeddings = deepAnalysis.embed_faces(batch, index.model_name)
+                matches = index.search(embeddings)
+            known = [index.attributes(match[0]) if match else None for match in matches]
+            results = faceResults.from_objs(index.record(
+                embeddings, matches, deepAnalysis.predict_batch(batch, actions, timer=timer, known=known,
+                                                                    engine=engine)))
+        offset = 0
+        for path, img, scale, faces in pending:
+            image_results = results[offset:offset + len(faces)]
+            offset += len(faces)
+            writer.write(path, image_results)
+            stats['faces'] += len(image_results)
+            stats['no_faces'] += not len(image_results)
+            if render_dir and len(image_results):
+                render_futures.append(pool.submit(render, path, img, scale, image_results.to_objs(),
+                                                          render_dir))
+        pending, pending_faces = [], 0
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        render_futures = []
+        paths = iter(iter_images(inputs))
+
+        def submit_next():
+            path = next(paths, None)
+            if path is not None:
+                in_flight.append((path, pool.submit(load_and_detect, path, detector_backend, align,
+                                                       detect_max_side, max_side)))
+
+        # 预取窗口限制同时在内存中的解码图片数量
+        for _ in range(workers * 2):
+            submit_next()
+
+        while in_flight:
+            path, future = in_flight.popleft()
+            submit_next()
+            stats['images'] += 1
+            try:
+                img, scale, faces = future.result()
+            except Exception as e:
+                stats['errors'] += 1
+                metrics.inc('batch_errors')
+                writer.write(path, error=str(e))
+                continue
+
+            if not faces and not pending:
+                # 没有人脸的图片不需要推理（也不绘制结果图），前面没有等待推理的图片时直接写出
+                writer.write(path, faceResults.empty(0))
+                stats['no_faces'] += 1
+                continue
+            # 没有人脸的图片只保留路径，保证输出顺序；等待的图片数同样以 batch_size 为上限
+            pending.append((path, img if render_dir and faces else None, scale, faces))
+            pending_faces += len(faces)
+            if pending_faces >= batch_size or len(pending) >= batch_size:
+                flush(pool, render_futures)
+
+        if pending:
+            flush(pool, render_futures)
+        for future in render_futures:
+            future.result()
+
+    writer.close()
+    stats['seconds'] = time.perf_counter() - start
+    stats['timings'] = timer.spans
+    metrics.inc('batch_images', stats['images'])
+    metrics.inc('batch_faces', stats['faces'])
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="批量表情分析：对目录或图片列表做人脸检测和属性推理")
+    parser.add_argument('inputs', nargs='+', help="图片目录、图片文件或每行一个路径的 .txt 列表")
+    parser.add_argument('-o', '--output', default='-',
+                        help="结果文件（.jsonl 或 .csv）或 npy 格式的目录，默认输出到标准输出")
+    parser.add_argument('--format', choices=['jsonl', 'csv', 'npy'], help="输出格式，默认按文件后缀判断")
+    parser.add_argument('--actions', default='emotion-only', choices=list(ACTION_PROFILES), help="分析模式")
+    parser.add_argument('--batch-size', type=int, default=32, help="每次前向推理的人脸数量")
+    parser.add_argument('--workers', type=int, default=4, help="解码/检测/绘制线程数")
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR, help="DeepFace 人脸检测后端")
+    parser.add_argument('--no-align', action='store_true', help="关闭人脸对齐")
+    parser.add_argument('--detect-max-side', type=int, help="检测前把图片缩小到的最长边")
+    parser.add_argument('--max-side', type=int, help="分析分辨率上限，大图（尤其是 JPEG）在解码时就缩小")
+    parser.add_argument('--engine', default=DEFAULT_ENGINE, choices=INFERENCE_ENGINES, help="属性模型的推理引擎")
+    parser.add_argument('--threads', type=int, help="ONNX 推理的 intra-op 线程数")
+    parser.add_argument('--render-dir', help="保存结果图的目录，不指定则不绘制")
+    parser.add_argument('--index', nargs='?', const='', help="用人脸身份索引识别人物，可指定索引目录")
+    parser.add_argument('--enroll', action='store_true', help="把索引中没有的人脸自动登记为新人物")
+    args = parser.parse_args()
+
+    onnxEngine.configure(threads=args.threads)
+    index = None
+    if args.index is not None:
+        from EmoIndex import faceIndex
+        index = faceIndex(args.index or None, auto_enroll=args.enroll)
+
+    stats = BatchAnalysis(args.inputs, args.output, actions=args.actions, batch_size=args.batch_size,
+                          workers=args.workers, fmt=args.format, render_dir=args.render_dir,
+                          detector_backend=args.detector, align=not args.no_align,
+                          detect_max_side=args.detect_max_side, index=index, max_side=args.max_side,
+                          engine=args.engine)
+    print(f"共处理 {stats['images']} 张图片，{stats['faces']} 张人脸，无人脸 {stats['no_faces']} 张，"
+          f"失败 {stats['errors']} 张，耗时 {stats['seconds']:.2f}s", file=sys.stderr)
+    print(f"各阶段平均耗时: {metrics.summary_text()}", file=sys.stderr)
@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import deepface
+from EmoAna import deepAnalysis, modelRegistry, AnalysisPipeline, ACTION_PROFILES, DEFAULT_DETECTOR
+from EmoMetrics import metrics
+from EmoOptions import iter_images
+
+
+# 进程峰值内存（MB），Linux / macOS 用 resource，Windows 尝试 psutil
+def peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / (1024 * 1024)
+    except (ImportError, AttributeError):
+        return None
+
+
+def percentiles(samples):
+    samples = np.asarray(samples, dtype=np.float64) * 1000
+    return {
+        'mean_ms': float(samples.mean()),
+        'p50_ms': float(np.percentile(samples, 50)),
+        'p90_ms': float(np.percentile(samples, 90)),
+        'p99_ms': float(np.percentile(samples, 99)),
+    }
+
+
+# 冷启动导入耗时（毫秒，取中位数）：每次都在新进程中导入，界面模块不应该触发 deepface / TensorFlow 的导入
+def startup_times(repeat=3):
+    here = os.path.dirname(os.path.abspath(__file__))
+    modules = {'gui_import_ms': 'EmoSystem_th', 'core_import_ms': 'EmoAna'}
+    report = {}
+    for name, module in modules.items():
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', f"import {module}"], cwd=here, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            samples.append(1000 * (time.perf_counter() - start))
+        report[name] = float(np.median(samples))
+    return report
+
+
+# 合成测试图：把真实人脸裁剪后按网格贴到指定尺寸的灰色画布上，用来控制图片大小和人脸数量
+def synthetic_image(face_crop, size, faces):
+    canvas = np.full((size, size, 3), 127, dtype=np.uint8)
+    grid = int(np.ceil(np.sqrt(faces)))
+    cell = size // grid
+    face_size = max(16, int(cell * 0.7))
+    face = cv2.resize(face_crop, (face_size, face_size), interpolation=cv2.INTER_AREA)
+    for index in range(faces):
+        row, col = divmod(index, grid)
+        y = row * cell + (cell - face_size) // 2
+        x = col * cell + (cell - face_size) // 2
+        canvas[y:y + face_size, x:x + face_size] = face
+    return canvas
+
+
+def encode_png(img):
+    ok, buffer = cv2.imencode('.png', img)
+    return buffer.tobytes()
+
+
+# 准备测试用例：{名称: 图片编码后的字节}，解码阶段从字节开始计时
+def build_cases(image_dir, sizes, face_counts, detector_backend):
+    cases = {}
+    paths = list(iter_images([image_dir])) if image_dir else []
+    for path in paths:
+        with open(path, 'rb') as f:
+            cases[os.path.basename(path)] = f.read()
+
+    if sizes and face_counts and paths:
+        # 用第一张能检测到人脸的图片作为合成图的人脸素材
+        face_crop = None
+        for path in paths:
+            img = deepAnalysis.read_img(path)
+            faces = [face for face in deepAnalysis.detect_faces(img, detector_backend) if face['confidence']]
+            if faces:
+                area = faces[0]['facial_area']
+                face_crop = img[area['y']:area['y'] + area['h'], area['x']:area['x'] + area['w']]
+                break
+        if face_crop is not None:
+            for size in sizes:
+                for count in face_counts:
+                    cases[f"synthetic_{size}px_{count}faces"] = encode_png(synthetic_image(face_crop, size, count))
+    return cases
+
+
+# 分阶段跑一次流水线，返回 {阶段: 秒}：decode、detect、infer_<动作>、parse、render、encode
+def run_stages(data, actions, detector_backend):
+    timings = {}
+
+    start = time.perf_counter()
+    img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    faces = deepAnalysis.detect_faces(img, detector_backend)
+    timings['detect'] = time.perf_counter() - start
+    # 与正式流水线一致：没有检测到人脸时的整图区域（confidence 为 0）和空裁剪不算人脸
+    faces = [face for face in faces if face['confidence'] and face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+
+    objs = [{} for _ in faces]
+    for action in actions:
+        start = time.perf_counter()
+        for obj, action_obj in zip(objs, deepAnalysis.predict_batch(faces, [action])):
+            obj.update(action_obj)
+        timings[f"infer_{action}"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    deepAnalysis.parse_deepface_result(objs)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    combined_img = deepAnalysis.draw_Ana_img(deepAnalysis.draw_red_box(img, objs), objs)
+    timings['render'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cv2.imencode('.png', combined_img)
+    timings['encode'] = time.perf_counter() - start
+    return timings
+
+
+def Benchmark(image_dir='qqemo', sizes=(640, 1920), face_counts=(1, 8), repeat=10, actions='emotion-only',
+              detector_backend=DEFAULT_DETECTOR, startup_repeat=3):
+    actions = deepAnalysis.resolve_actions(actions)
+    report = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'deepface': deepface.__version__,
+            'opencv': cv2.__version__,
+            'actions': actions,
+            'detector_backend': detector_backend,
+            'repeat': repeat,
+        },
+        'cases': {},
+    }
+
+    if startup_repeat:
+        report['startup'] = startup_times(startup_repeat)
+
+    # 模型加载时间（冷启动的主要部分）
+    start = time.perf_counter()
+    modelRegistry.load(actions, detector_backend=detector_backend)
+    report['model_load'] = {'total_ms': 1000 * (time.perf_counter() - start),
+                            **{key: 1000 * value for key, value in modelRegistry.timings.items()}}
+
+    cases = build_cases(image_dir, sizes, face_counts, detector_backend)
+    for name, data in cases.items():
+        # 第一次运行包含计算图构建等一次性开销，单独记为冷启动
+        cold = run_stages(data, actions, detector_backend)
+        samples = {}
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for stage, seconds in run_stages(data, actions, detector_backend).items():
+                samples.setdefault(stage, []).append(seconds)
+        elapsed = time.perf_counter() - start
+
+        # 完整的 AnalysisPipeline（不使用缓存）端到端耗时
+        end_to_end = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            AnalysisPipeline(img=cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR),
+                             actions=actions, cache=None, detector_backend=detector_backend)
+            end_to_end.append(time.perf_counter() - start)
+
+        report['cases'][name] = {
+            'cold_ms': {stage: 1000 * seconds for stage, seconds in cold.items()},
+            'stages': {stage: percentiles(values) for stage, values in samples.items()},
+            'pipeline': percentiles(end_to_end),
+            'throughput_ips': repeat / elapsed,
+        }
+        print(f"{name}: p50 {report['cases'][name]['pipeline']['p50_ms']:.1f}ms, "
+              f"{report['cases'][name]['throughput_ips']:.2f} img/s", file=sys.stderr)
+
+    report['peak_rss_mb'] = peak_rss_mb()
+    report['metrics'] = metrics.snapshot()
+    return report
+
+
+# 与基线比较：任一用例的任一阶段 p50 比基线慢超过 threshold（比例）即视为回归
+def compare(report, baseline, threshold=0.15, min_ms=1.0):
+    regressions = []
+    for name, case in report['cases'].items():
+        base_case = baseline.get('cases', {}).get(name)
+        if not base_case:
+            continue
+        checks = [(f"stage:{stage}", values['p50_ms'], base_case['stages'].get(stage, {}).get('p50_ms'))
+                  for stage, values in case['stages'].items()]
+        checks.append(('pipeline', case['pipeline']['p50_ms'], base_case['pipeline']['p50_ms']))
+        for metric, current, base in checks:
+            # 很快的阶段抖动大，低于 min_ms 的差异不计
+            if base is not None and current - base > max(base * threshold, min_ms):
+                regressions.append({'case': name, 'metric': metric, 'baseline_ms': base, 'current_ms': current,
+                                    'change': current / base - 1 if base else None})
+
+    for metric, current in report.get('startup', {}).items():
+        base = baseline.get('startup', {}).get(metric)
+        if base is not None and current - base > max(base * threshold, min_ms):
+            regressions.append({'case': 'startup', 'metric': metric, 'baseline_ms': base, 'current_ms': current,
+                                'change': current / base - 1 if base else None})
+
+    base_rss, rss = baseline.get('peak_rss_mb'), report.get('peak_rss_mb')
+    if base_rss and rss and rss > base_rss * (1 + threshold):
+        regressions.append({'case': '*', 'metric': 'peak_rss_mb', 'baseline': base_rss, 'current': rss,
+                            'change': rss / base_rss - 1})
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EmoAna 流水线性能基准测试")
+    parser.add_argument('--images', default='qqemo', help="真实测试图片目录，传空字符串则只用合成图")
+    parser.add_argument('--sizes', type=int, nargs='*', default=[640, 1920], help="合成图边长")
+    parser.add_argument('--faces', type=int, nargs='*', default=[1, 8], help="合成图中的人脸数量")
+    parser.add_argument('--repeat', type=int, default=10, help="每个用例的重复次数")
+    parser.add_argument('--actions', default='emotion-only', choices=list(ACTION_PROFILES))
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR)
+    parser.add_argument('--startup-repeat', type=int, default=3, help="冷启动导入耗时的测量次数，0 表示跳过")
+    parser.add_argument('-o', '--output', default='bench_results.json', help="结果 JSON 文件")
+    parser.add_argument('--baseline', help="基线 JSON 文件，指定后会比较并在回归时返回非零退出码")
+    parser.add_argument('--threshold', type=float, default=0.15, help="判定回归的变慢比例")
+    parser.add_argument('--save-baseline', action='store_true', help="把本次结果写为新的基线")
+    args = parser.parse_args()
+
+    report = Benchmark(args.images, args.sizes, args.faces, args.repeat, args.actions, args.detector,
+                       args.startup_repeat)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"结果已保存至: {args.output}", file=sys.stderr)
+
+    if args.baseline:
+        if args.save_baseline or not os.path.exists(args.baseline):
+            with open(args.baseline, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            print(f"基线已保存至: {args.baseline}", file=sys.stderr)
+        else:
+            with open(args.baseline, encoding='utf-8') as f:
+                regressions = compare(report, json.load(f), args.threshold)
+            for item in regressions:
+                print(f"性能回归: {item}", file=sys.stderr)
+            sys.exit(1 if regressions else 0)
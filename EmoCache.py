@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# 默认的磁盘缓存位置，可以通过环境变量 EMO_CACHE_DIR 修改
+DEFAULT_CACHE_DIR = os.environ.get('EMO_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.emoana'))
+
+
+# 分析结果缓存：键为图片内容哈希 + 分析动作 + 模型/检测器版本，
+# 内存中是有上限的 LRU，后面是持久化的 SQLite 存储，重启后依然有效；
+# 两层都保存 JSON 文本，每次命中都解析出一份新的结果，调用方修改返回的结果不会影响之后的命中
+class resultCache:
+    _default = None
+
+    def __init__(self, path=None, max_entries=256):
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+        self.db = None
+        if path != ':memory:':
+            path = path or os.path.join(DEFAULT_CACHE_DIR, 'result_cache.sqlite3')
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, created REAL)")
+            self.db.commit()
+
+    # 进程内共享的默认缓存
+    @classmethod
+    def default(cls):
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    # data 为图片文件的原始字节或解码后的数组；versions 为模型、检测器等会影响结果的版本信息
+    def make_key(self, data, actions, *versions):
+        digest = hashlib.sha256()
+        if hasattr(data, 'tobytes'):
+            digest.update(str(data.shape).encode())
+            data = data.tobytes()
+        digest.update(data)
+        return f"{digest.hexdigest()}|{','.join(sorted(actions))}|{'|'.join(str(v) for v in versions)}"
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return json.loads(self.memory[key])
+
+            row = None
+            if self.db is not None:
+                row = self.db.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+
+            self.stats['disk_hits'] += 1
+            self._remember(key, row[0])
+            return json.loads(row[0])
+
+    # value 必须可以 JSON 序列化（numpy 数值需要先转换成 Python 类型）
+    def put(self, key, value):
+        text = json.dumps(value, ensure_ascii=False)
+        with self.lock:
+            self._remember(key, text)
+            if self.db is not None:
+                self.db.execute("INSERT OR REPLACE INTO results (key, value, created) VALUES (?, ?, ?)",
+                                (key, text, time.time()))
+                self.db.commit()
+
+    def _remember(self, key, value):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            if self.db is not None:
+                self.db.execute("DELETE FROM results")
+                self.db.commit()
+
+    def stats_text(self):
+        hits = self.stats['memory_hits'] + self.stats['disk_hits']
+        return f"缓存命中 {hits}（内存 {self.stats['memory_hits']} / 磁盘 {self.stats['disk_hits']}），未命中 {self.stats['misses']}"
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
@@ -0,0 +1,178 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+from EmoCache import DEFAULT_CACHE_DIR
+from EmoMetrics import metrics
+
+# 可选的 CPU 推理引擎：把本地缓存的 DeepFace 情绪 / 性别模型转换为 ONNX（float32 和 int8 动态量化两种），
+# 用 onnxruntime 整批推理，比 Keras 的 predict 开销小、占用内存少。需要另外安装：
+#   pip install onnxruntime tf2onnx   （tf2onnx 只在第一次转换时需要）
+# 转换结果保存在缓存目录下，只需转换一次；deepAnalysis 按次通过 engine 参数选择引擎，
+# 采用前先用 python EmoEngine.py check 在 qqemo/ 上对比与 DeepFace 原模型的结果
+
+# 引擎名 -> 模型精度
+ENGINE_PRECISIONS = {'onnx': 'fp32', 'onnx-int8': 'int8'}
+# 支持转换的属性模型及其输入形状（不含 batch 维）
+ENGINE_INPUTS = {'emotion': (48, 48, 1), 'gender': (224, 224, 3)}
+DEFAULT_ENGINE_DIR = os.path.join(DEFAULT_CACHE_DIR, 'onnx')
+
+
+# ONNX 模型的转换和推理会话，与 modelRegistry 一样在进程内共享
+class onnxEngine:
+    lock = threading.Lock()
+    sessions = {}  # (动作, 精度) -> onnxruntime.InferenceSession
+    threads = None  # 每次推理使用的 intra-op 线程数，None 时由 onnxruntime 决定（物理核数）
+    path = DEFAULT_ENGINE_DIR
+
+    # 修改线程数或模型目录，已经创建的会话会被丢弃，下次推理时按新配置重建
+    def configure(threads=None, path=None):
+        with onnxEngine.lock:
+            onnxEngine.threads = threads
+            onnxEngine.path = path or DEFAULT_ENGINE_DIR
+            onnxEngine.sessions.clear()
+
+    def supports(engine, action):
+        return engine in ENGINE_PRECISIONS and action in ENGINE_INPUTS
+
+    def model_path(action, precision='fp32'):
+        return os.path.join(onnxEngine.path, f"{action}.{precision}.onnx")
+
+    # 把 Keras 模型转换为 ONNX 文件；int8 在 float32 模型的基础上做动态量化（权重 int8，激活在运行时量化）
+    def convert(action, keras_model, precision='fp32'):
+        fp32_path = onnxEngine.model_path(action, 'fp32')
+        if not os.path.exists(fp32_path):
+            try:
+                import tensorflow as tf
+                import tf2onnx
+            except ImportError:
+                raise ImportError("转换 ONNX 模型需要安装 tf2onnx: pip install tf2onnx")
+            os.makedirs(onnxEngine.path, exist_ok=True)
+            start = time.perf_counter()
+            spec = [tf.TensorSpec((None, *ENGINE_INPUTS[action]), tf.float32, name='input')]
+            tf2onnx.convert.from_keras(keras_model, input_signature=spec, opset=13, output_path=f"{fp32_path}.tmp")
+            os.replace(f"{fp32_path}.tmp", fp32_path)
+            metrics.observe('engine_convert_ms', 1000 * (time.perf_counter() - start))
+
+        path = onnxEngine.model_path(action, precision)
+        if precision == 'int8' and not os.path.exists(path):
+            try:
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+            except ImportError:
+                raise ImportError("量化 ONNX 模型需要安装 onnxruntime: pip install onnxruntime")
+            quantize_dynamic(fp32_path, f"{path}.tmp", weight_type=QuantType.QInt8)
+            os.replace(f"{path}.tmp", path)
+        return path
+
+    # 推理会话；模型还没有转换过时调用 source() 取得 Keras 模型并转换，没有 source 时报错
+    def session(action, precision='fp32', source=None):
+        key = (action, precision)
+        with onnxEngine.lock:
+            if key not in onnxEngine.sessions:
+                path = onnxEngine.model_path(action, precision)
+                if not os.path.exists(path):
+                    if source is None:
+                        raise FileNotFoundError(f"没有找到 ONNX 模型: {path}，请先运行 python EmoEngine.py convert")
+                    path = onnxEngine.convert(action, source(), precision)
+                try:
+                    import onnxruntime as ort
+                except ImportError:
+                    raise ImportError("ONNX 推理引擎需要安装 onnxruntime: pip install onnxruntime")
+
+                start = time.perf_counter()
+                options = ort.SessionOptions()
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                options.inter_op_num_threads = 1
+                if onnxEngine.threads:
+                    options.intra_op_num_threads = onnxEngine.threads
+                onnxEngine.sessions[key] = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+                metrics.observe(f"engine_load_{action}_{precision}_ms", 1000 * (time.perf_counter() - start))
+        return onnxEngine.sessions[key]
+
+    # 整批推理，返回与 Keras model.predict 相同形状的原始输出
+    def predict(action, inputs, engine='onnx', source=None):
+        session = onnxEngine.session(action, ENGINE_PRECISIONS[engine], source)
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        return session.run(None, {session.get_inputs()[0].name: inputs})[0]
+
+
+# 精度对比：在 image_dir 的图片上检测人脸，分别用 DeepFace 原模型（TensorFlow）和各个引擎推理同一批人脸，
+# 统计概率的平均 / 最大绝对误差（百分点）、主要标签一致率和推理耗时；
+# 一致率低于 min_agreement 或平均误差高于 max_mean_diff 的组合判为不通过
+def parity_check(image_dir='qqemo', actions=('emotion', 'gender'), engines=tuple(ENGINE_PRECISIONS),
+                 detector_backend=None, min_agreement=0.98, max_mean_diff=1.0):
+    from EmoAna import deepAnalysis, DEFAULT_DETECTOR
+    from EmoOptions import iter_images
+
+    faces = []
+    for path in iter_images([image_dir]):
+        img = deepAnalysis.read_img(path)
+        faces += [face for face in deepAnalysis.detect_faces(img, detector_backend=detector_backend or DEFAULT_DETECTOR)
+                  if face['confidence'] and face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+    if not faces:
+        raise ValueError(f"{image_dir} 中没有检测到人脸")
+
+    actions = list(actions)
+    start = time.perf_counter()
+    reference = deepAnalysis.predict_arrays(faces, actions)
+    report = {'faces': len(faces), 'reference_ms': 1000 * (time.perf_counter() - start), 'engines': {}}
+    for engine in engines:
+        deepAnalysis.predict_arrays(faces[:1], actions, engine=engine)  # 转换模型、创建会话
+        start = time.perf_counter()
+        results = deepAnalysis.predict_arrays(faces, actions, engine=engine)
+        entry = {'infer_ms': 1000 * (time.perf_counter() - start), 'actions': {}}
+        for action in actions:
+            expected, actual = getattr(reference, action), getattr(results, action)
+            diff = np.abs(expected - actual)
+            agreement = float(np.mean(np.argmax(expected, axis=1) == np.argmax(actual, axis=1)))
+            entry['actions'][action] = {
+                'mean_abs_diff': float(diff.mean()),
+                'max_abs_diff': float(diff.max()),
+                'agreement': agreement,
+                'passed': agreement >= min_agreement and float(diff.mean()) <= max_mean_diff,
+            }
+        entry['passed'] = all(item['passed'] for item in entry['actions'].values())
+        report['engines'][engine] = entry
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="ONNX / int8 CPU 推理引擎：转换模型、对比精度")
+    parser.add_argument('--threads', type=int, help="onnxruntime 的 intra-op 线程数")
+    parser.add_argument('--path', help="ONNX 模型目录，默认在缓存目录下")
+    commands = parser.add_subparsers(dest='command', required=True)
+    convert_parser = commands.add_parser('convert', help="把本地缓存的 DeepFace 模型转换为 ONNX（float32 + int8）")
+    convert_parser.add_argument('--actions', nargs='*', default=list(ENGINE_INPUTS), choices=list(ENGINE_INPUTS))
+    check_parser = commands.add_parser('check', help="在测试图片上对比各引擎与 DeepFace 原模型的结果")
+    check_parser.add_argument('--images', default='qqemo', help="测试图片目录")
+    check_parser.add_argument('--actions', nargs='*', default=list(ENGINE_INPUTS), choices=list(ENGINE_INPUTS))
+    check_parser.add_argument('--engines', nargs='*', default=list(ENGINE_PRECISIONS), choices=list(ENGINE_PRECISIONS))
+    check_parser.add_argument('--detector', help="DeepFace 人脸检测后端")
+    check_parser.add_argument('--min-agreement', type=float, default=0.98, help="主要标签一致率下限")
+    check_parser.add_argument('--max-mean-diff', type=float, default=1.0, help="概率平均绝对误差上限（百分点）")
+    check_parser.add_argument('-o', '--output', help="把对比结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    # 作为脚本运行时本文件是 __main__，而 EmoAna 导入的是 EmoEngine 模块中的 onnxEngine（另一个类对象），
+    # 配置必须作用在后者上，parity_check 推理时才会用到 --threads / --path
+    import EmoEngine
+    EmoEngine.onnxEngine.configure(args.threads, args.path)
+    if args.command == 'convert':
+        from EmoAna import modelRegistry
+        for action in args.actions:
+            keras_model = modelRegistry.load([action], detector_backend=None)[0].model
+            for precision in ENGINE_PRECISIONS.values():
+                print(f"{action} {precision}: {EmoEngine.onnxEngine.convert(action, keras_model, precision)}")
+    else:
+        report = EmoEngine.parity_check(args.images, args.actions, args.engines, args.detector,
+                                        args.min_agreement, args.max_mean_diff)
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+        sys.exit(0 if all(entry['passed'] for entry in report['engines'].values()) else 1)
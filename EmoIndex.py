@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import numpy as np
+
+from EmoAna import deepAnalysis, DEFAULT_DETECTOR, DEFAULT_RECOGNIZER, SUBJECT_ATTRIBUTES
+from EmoOptions import iter_images
+from EmoCache import DEFAULT_CACHE_DIR
+from EmoMetrics import metrics
+
+# 人脸身份索引：特征向量存放在内存映射文件中（按需扩容，不会整体读入内存），
+# 每个向量属于哪个人、每个人缓存的属性（年龄、性别、人种）存放在 SQLite 中。
+# 支持增量添加和删除，查询时用一次矩阵乘法算出与所有向量的余弦相似度，不需要逐张扫描人脸库。
+# 原来的方式: DeepFace.stream("database") 每次启动都要扫描 database 目录重建表示
+
+
+class faceIndex:
+    def __init__(self, path=None, model_name=None, threshold=0.40, auto_enroll=False):
+        self.model_name = model_name or DEFAULT_RECOGNIZER
+        self.subject_keys = [key for keys in SUBJECT_ATTRIBUTES.values() for key in keys]
+        # 余弦距离阈值（1 - 相似度），与 DeepFace.verify 中 Facenet + cosine 的默认阈值一致
+        self.threshold = threshold
+        # 为 True 时没有匹配上的人脸会自动登记为新的人物（subject_<编号>）
+        self.auto_enroll = auto_enroll
+        self.lock = threading.RLock()
+
+        self.path = path or os.path.join(DEFAULT_CACHE_DIR, 'face_index', self.model_name)
+        os.makedirs(self.path, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.path, 'index.sqlite3'), check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (slot INTEGER PRIMARY KEY, identity TEXT, created REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS subjects (identity TEXT PRIMARY KEY, attributes TEXT, "
+                        "updated REAL)")
+        self.db.commit()
+
+        meta = dict(self.db.execute("SELECT key, value FROM meta").fetchall())
+        self.dim = int(meta['dim']) if 'dim' in meta else None
+        self.capacity = int(meta.get('capacity', 0))
+        self.size = int(meta.get('size', 0))  # 已经使用过的槽位上限，删除后的空槽位会被复用
+        self.next_subject = int(meta.get('next_subject', 1))  # 自动编号，删除后不会重复使用
+
+        # 每个槽位所属的人物，None 表示空槽位
+        self.labels = [None] * self.capacity
+        for slot, identity in self.db.execute("SELECT slot, identity FROM entries"):
+            self.labels[slot] = identity
+        self.active = np.array([label is not None for label in self.labels], dtype=bool)
+        self.free = [slot for slot in range(self.size) if self.labels[slot] is None]
+
+        self.vectors = None
+        if self.dim and self.capacity:
+            self.vectors = np.memmap(self.vectors_path(), dtype=np.float32, mode='r+',
+                                     shape=(self.capacity, self.dim))
+
+    def vectors_path(self):
+        return os.path.join(self.path, 'vectors.f32')
+
+    def save_meta(self):
+        self.db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                            [('dim', str(self.dim)), ('capacity', str(self.capacity)), ('size', str(self.size)),
+                             ('next_subject', str(self.next_subject))])
+
+    # 容量不够时按倍数扩大映射文件
+    def reserve(self, count):
+        if self.size + count <= self.capacity:
+            return
+        capacity = max(1024, self.capacity * 2, self.size + count)
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.vectors = None
+        with open(self.vectors_path(), 'ab') as f:
+            f.truncate(capacity * self.dim * 4)
+        self.vectors = np.memmap(self.vectors_path(), dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.labels += [None] * (capacity - self.capacity)
+        self.active = np.concatenate([self.active, np.zeros(capacity - self.capacity, dtype=bool)])
+        self.capacity = capacity
+
+    # 登记一个人的若干特征向量（已 L2 归一化），identity 为空时自动编号；attributes 为该人物的固定属性
+    def add(self, embeddings, identity=None, attributes=None):
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        with self.lock:
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+            elif embeddings.shape[1] != self.dim:
+                raise ValueError(f"特征维度不一致: {embeddings.shape[1]} != {self.dim}")
+            if identity is None:
+                identity = f"subject_{self.next_subject}"
+                self.next_subject += 1
+
+            slots = []
+            for _ in embeddings:
+                if self.free:
+                    slots.append(self.free.pop())
+                else:
+                    self.reserve(1)
+                    slots.append(self.size)
+                    self.size += 1
+            self.vectors[slots] = embeddings
+            self.vectors.flush()
+            for slot in slots:
+                self.labels[slot] = identity
+                self.active[slot] = True
+
+            now = time.time()
+            self.db.executemany("INSERT OR REPLACE INTO entries (slot, identity, created) VALUES (?, ?, ?)",
+                                [(slot, identity, now) for slot in slots])
+            self.db.execute("INSERT OR IGNORE INTO subjects (identity, attributes, updated) VALUES (?, '{}', ?)",
+                            (identity, now))
+            self.save_meta()
+            self.db.commit()
+            if attributes:
+                self.update_attributes(identity, attributes)
+        return identity
+
+    # 删除一个人物的所有向量和缓存属性，槽位留给之后的 add 复用
+    def delete(self, identity):
+        with self.lock:
+            slots = [slot for slot, label in enumerate(self.labels) if label == identity]
+            for slot in slots:
+                self.labels[slot] = None
+                self.active[slot] = False
+            self.free += slots
+            self.db.execute("DELETE FROM entries WHERE identity = ?", (identity,))
+            self.db.execute("DELETE FROM subjects WHERE identity = ?", (identity,))
+            self.db.commit()
+        return len(slots)
+
+    def identities(self):
+        with self.lock:
+            return {identity: count for identity, count in
+                    self.db.execute("SELECT identity, COUNT(*) FROM entries GROUP BY identity ORDER BY identity")}
+
+    # 批量最近邻查询：返回与 embeddings 对应的 (人物, 余弦距离)，距离超过阈值时为 None
+    def search(self, embeddings):
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        with self.lock:
+            if self.vectors is None or not self.active[:self.size].any() or not len(embeddings):
+                return [None] * len(embeddings)
+            similarities = embeddings @ self.vectors[:self.size].T
+            similarities[:, ~self.active[:self.size]] = -np.inf
+            best = similarities.argmax(axis=1)
+            distances = 1 - similarities[np.arange(len(embeddings)), best]
+            matches = [(self.labels[slot], float(distance)) if distance <= self.threshold else None
+                       for slot, distance in zip(best, distances)]
+        metrics.inc('index_matches', sum(match is not None for match in matches))
+        metrics.inc('index_misses', sum(match is None for match in matches))
+        return matches
+
+    def attributes(self, identity):
+        with self.lock:
+            row = self.db.execute("SELECT attributes FROM subjects WHERE identity = ?", (identity,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # 合并人物的固定属性（只保存 SUBJECT_ATTRIBUTES 中的字段），已有的值不会被覆盖
+    def update_attributes(self, identity, attributes):
+        with self.lock:
+            current = self.attributes(identity) or {}
+            new = {key: value for key, value in deepAnalysis.to_builtin(attributes).items()
+                   if key in self.subject_keys and key not in current}
+            if not new:
+                return
+            current.update(new)
+            self.db.execute("INSERT OR REPLACE INTO subjects (identity, attributes, updated) VALUES (?, ?, ?)",
+                            (identity, json.dumps(current, ensure_ascii=False), time.time()))
+            self.db.commit()
+
+    # 分析结束后调用：给结果加上 identity / identity_distance，缓存已知人物新算出的固定属性，
+    # auto_enroll 时登记新出现的人物；matches 是登记前查询的，同一批中后面还没匹配上的人脸要再和刚登记的人物比较，
+    # 同一个新人物在一批中出现多次（多帧或合影中重复）时只登记一次
+    def record(self, embeddings, matches, objs):
+        embeddings = np.atleast_2d(np.asarray(embeddings, dtype=np.float32))
+        matches = list(matches)
+        enrolled = set()  # 本批中新登记的人物
+        for i, (embedding, obj) in enumerate(zip(embeddings, objs)):
+            match = matches[i]
+            if match is None and self.auto_enroll:
+                match = (self.add(embedding, attributes=obj), 0.0)
+                enrolled.add(match[0])
+                # 只重新比较没有匹配上的，以及已经匹配到本批新人物的人脸（可能离这个新人物更近）
+                rest = [j for j in range(i + 1, len(matches)) if matches[j] is None or matches[j][0] in enrolled]
+                if rest:
+                    distances = 1 - embeddings[rest] @ embedding
+                    for j, distance in zip(rest, distances):
+                        if distance <= self.threshold and (matches[j] is None or distance < matches[j][1]):
+                            matches[j] = (match[0], float(distance))
+            elif match is not None:
+                self.update_attributes(match[0], obj)
+            obj['identity'] = match[0] if match else None
+            obj['identity_distance'] = match[1] if match else None
+        return objs
+
+    def close(self):
+        with self.lock:
+            if self.vectors is not None:
+                self.vectors.flush()
+                self.vectors = None
+            self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="人脸身份索引：登记、删除、查看和查询人物")
+    parser.add_argument('--index', help="索引目录，默认在缓存目录下")
+    parser.add_argument('--model', help="特征提取模型，默认 Facenet")
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR, help="DeepFace 人脸检测后端")
+    commands = parser.add_subparsers(dest='command', required=True)
+    add_parser = commands.add_parser('add', help="把图片中最大的人脸登记为指定人物")
+    add_parser.add_argument('identity')
+    add_parser.add_argument('inputs', nargs='+', help="图片、目录或路径列表（.txt）")
+    delete_parser = commands.add_parser('delete', help="删除人物")
+    delete_parser.add_argument('identity')
+    commands.add_parser('list', help="列出人物及登记的人脸数")
+    search_parser = commands.add_parser('search', help="查询图片中每张人脸的身份")
+    search_parser.add_argument('inputs', nargs='+')
+    args = parser.parse_args()
+
+    index = faceIndex(args.index, args.model)
+    if args.command == 'add':
+        faces = []
+        for path in iter_images(args.inputs):
+            detected = [face for face in deepAnalysis.detect_faces(deepAnalysis.read_img(path), args.detector)
+                        if face['confidence']]
+            if detected:
+                faces.append(max(detected, key=lambda face: face['facial_area']['w'] * face['facial_area']['h']))
+            else:
+                print(f"未检测到人脸: {path}", file=sys.stderr)
+        if faces:
+            index.add(deepAnalysis.embed_faces(faces, index.model_name), args.identity)
+            print(f"已登记 {args.identity}: {len(faces)} 张人脸")
+    elif args.command == 'delete':
+        print(f"已删除 {args.identity}: {index.delete(args.identity)} 张人脸")
+    elif args.command == 'list':
+        for identity, count in index.identities().items():
+            print(f"{identity}\t{count}\t{index.attributes(identity)}")
+    else:
+        for path in iter_images(args.inputs):
+            faces = [face for face in deepAnalysis.detect_faces(deepAnalysis.read_img(path), args.detector)
+                     if face['confidence']]
+            for face, match in zip(faces, index.search(deepAnalysis.embed_faces(faces, index.model_name))):
+                print(f"{path}\t{face['facial_area']}\t{match}")
+    index.close()
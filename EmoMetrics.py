@@ -0,0 +1,141 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+
+
+# 运行指标：计数器和耗时直方图，进程内共享，界面状态栏、批量工具和基准测试都从这里读取
+class metricsRegistry:
+    # 直方图的桶上界（毫秒），最后一个桶收集所有更大的值
+    BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, ms):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = {'buckets': [0] * (len(self.BUCKETS_MS) + 1), 'count': 0,
+                                                'sum_ms': 0.0, 'max_ms': 0.0}
+            index = next((i for i, bound in enumerate(self.BUCKETS_MS) if ms <= bound), len(self.BUCKETS_MS))
+            hist['buckets'][index] += 1
+            hist['count'] += 1
+            hist['sum_ms'] += ms
+            hist['max_ms'] = max(hist['max_ms'], ms)
+
+    # 根据直方图估算分位数（取所在桶的上界）
+    def quantile(self, name, q):
+        with self.lock:
+            hist = self.histograms.get(name)
+            if not hist or not hist['count']:
+                return None
+            target = q * hist['count']
+            seen = 0
+            for bound, count in zip(self.BUCKETS_MS + (hist['max_ms'],), hist['buckets']):
+                seen += count
+                if seen >= target:
+                    return min(bound, hist['max_ms'])
+            return hist['max_ms']
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'histograms': {name: {**hist, 'buckets': list(hist['buckets']),
+                                      'mean_ms': hist['sum_ms'] / hist['count'] if hist['count'] else 0.0}
+                               for name, hist in self.histograms.items()},
+                'buckets_ms': list(self.BUCKETS_MS),
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    # 各阶段平均耗时的简短文本，供界面状态栏显示
+    def summary_text(self, prefix='stage_'):
+        return snapshot_text(self.snapshot(), prefix)
+
+
+metrics = metricsRegistry()
+
+
+# snapshot() 结果的简短文本（各阶段平均耗时 + 计数器）
+def snapshot_text(snapshot, prefix='stage_'):
+    parts = [f"{name[len(prefix):-3]} {hist['mean_ms']:.0f}ms" for name, hist in snapshot['histograms'].items()
+             if name.startswith(prefix)]
+    counters = ", ".join(f"{name} {value}" for name, value in snapshot['counters'].items())
+    return " / ".join(parts) + (f"\n{counters}" if counters else "")
+
+
+# 合并多个进程的 snapshot()（计数器和直方图逐项相加），用于汇总推理进程的指标
+def merge_snapshots(snapshots):
+    merged = {'counters': {}, 'histograms': {}, 'buckets_ms': list(metricsRegistry.BUCKETS_MS)}
+    for snapshot in snapshots:
+        if not snapshot:
+            continue
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        for name, hist in snapshot['histograms'].items():
+            total = merged['histograms'].get(name)
+            if total is None:
+                merged['histograms'][name] = {**hist, 'buckets': list(hist['buckets'])}
+                continue
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], hist['buckets'])]
+            total['count'] += hist['count']
+            total['sum_ms'] += hist['sum_ms']
+            total['max_ms'] = max(total['max_ms'], hist['max_ms'])
+            total['mean_ms'] = total['sum_ms'] / total['count'] if total['count'] else 0.0
+    return merged
+
+
+# 一次分析中的阶段计时：with timer.span('detect'): ...
+# 耗时（毫秒）记在 timer.spans 中随结果返回，同时写入全局直方图 stage_<阶段>_ms
+class stageTimer:
+    def __init__(self, registry=metrics):
+        self.registry = registry
+        self.spans = {}
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ms = 1000 * (time.perf_counter() - start)
+            self.spans[name] = self.spans.get(name, 0.0) + ms
+            if self.registry is not None:
+                self.registry.observe(f"stage_{name}_ms", ms)
+
+
+# 单次分析各阶段耗时的文本：decode 3ms / detect 41ms / ...
+def timings_text(spans):
+    return " / ".join(f"{stage} {ms:.0f}ms" for stage, ms in spans.items())
+
+
+# 可按次开启的 cProfile：with profiled(True) as report: ...，结束后 report['text'] 为按累计耗时排序的统计
+@contextmanager
+def profiled(enabled=True, limit=30):
+    report = {}
+    if not enabled:
+        yield report
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield report
+    finally:
+        profiler.disable()
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        report['text'] = stream.getvalue()
@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+
+from EmoMetrics import metrics
+
+# 轻量的选项常量和分析核心的延迟导入：界面启动时只需要这里的内容，
+# 不会在窗口出现之前导入 deepface / TensorFlow / cv2（这些由 EmoAna 导入）
+
+# 分析动作预设：界面只展示情绪（叠加图里再加上性别），不需要每次都跑年龄和人种模型
+ACTION_PROFILES = {
+    'emotion-only': ['emotion'],
+    'emotion+gender': ['gender', 'emotion'],
+    'full': ['age', 'gender', 'race', 'emotion'],
+}
+DEFAULT_PROFILE = 'full'
+
+# 可选的人脸检测后端（DeepFace 支持的名称），越靠前越快、越靠后越准
+DETECTOR_BACKENDS = ['opencv', 'ssd', 'yunet', 'centerface', 'mediapipe', 'mtcnn', 'fastmtcnn', 'yolov8', 'dlib',
+                     'retinaface']
+DEFAULT_DETECTOR = 'opencv'
+
+# 属性模型的推理引擎：tensorflow 为 DeepFace 原模型，onnx / onnx-int8 见 EmoEngine（只覆盖情绪和性别模型）
+INFERENCE_ENGINES = ['tensorflow', 'onnx', 'onnx-int8']
+DEFAULT_ENGINE = 'tensorflow'
+
+# 界面默认的分析分辨率上限（最长边）：手机拍的 12MP 以上照片在解码时就缩小到这个尺寸以内，
+# 检测和结果图都在缩小后的图片上进行，人脸框仍按原图坐标返回
+DEFAULT_MAX_SIDE = 2048
+
+# 批量分析 / 界面选择文件夹时会处理的图片后缀
+IMAGE_EXTS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.webp')
+# Analysis() 写出的派生图片，批量分析时跳过
+DERIVED_SUFFIXES = ('_redbox', '_analyzed')
+
+
+# 收集待分析图片：支持目录、单张图片，以及每行一个路径的列表文件（.txt）
+def iter_images(inputs):
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    stem, ext = os.path.splitext(name)
+                    if ext.lower() in IMAGE_EXTS and not stem.endswith(DERIVED_SUFFIXES):
+                        yield os.path.join(root, name)
+        elif item.lower().endswith('.txt'):
+            with open(item, encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        yield line
+        else:
+            yield item
+
+
+# 分析核心 EmoAna 的延迟导入，以及启动各阶段的耗时记录（毫秒，从导入本模块开始计时）
+class coreLoader:
+    lock = threading.Lock()
+    module = None
+    started = time.perf_counter()
+    startup = {}  # 'window'、'import_core'、'models_ready' 等
+
+    # 导入 EmoAna 并返回模块，第一次调用会比较慢，应在后台线程中调用
+    def load():
+        with coreLoader.lock:
+            if coreLoader.module is None:
+                start = time.perf_counter()
+                import EmoAna
+                coreLoader.module = EmoAna
+                ms = 1000 * (time.perf_counter() - start)
+                coreLoader.startup['import_core'] = ms
+                metrics.observe('startup_import_core_ms', ms)
+        return coreLoader.module
+
+    # 记录在其他进程中测得的阶段耗时（例如推理进程导入分析核心的时间），同一阶段只记录第一次
+    def record(stage, ms):
+        if stage not in coreLoader.startup:
+            coreLoader.startup[stage] = ms
+            metrics.observe(f"startup_{stage}_ms", ms)
+
+    # 已经导入完成时返回 EmoAna 模块，否则返回 None（不会触发导入）
+    def loaded():
+        return coreLoader.module
+
+    # 记录从启动到某个时刻的耗时，同一阶段只记录第一次
+    def mark(stage):
+        if stage not in coreLoader.startup:
+            ms = 1000 * (time.perf_counter() - coreLoader.started)
+            coreLoader.startup[stage] = ms
+            metrics.observe(f"startup_{stage}_ms", ms)
+
+    def startup_text():
+        names = {'window': '窗口显示', 'import_core': '依赖导入', 'models_ready': '模型就绪'}
+        return " / ".join(f"{names.get(stage, stage)} {ms / 1000:.1f}s" for stage, ms in coreLoader.startup.items())
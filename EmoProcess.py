@@ -0,0 +1,406 @@
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import CancelledError, Future
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+from EmoMetrics import metrics, merge_snapshots
+from EmoOptions import coreLoader
+
+# 进程外推理：分析核心和模型只在独立的工作进程（一个或几个）中加载，界面进程只负责显示，
+# 推理占用的 GIL、内存以及模型崩溃都不会影响窗口。
+# 每个工作进程通过一条双向管道收发任务，管道中只传递参数、结果字典和共享内存的名字与布局；
+# 图片数组（输入帧、结果图、缩略图）都放在共享内存中，不经过 pickle 也不写临时文件。
+# 工作进程异常退出或任务超时时自动重启（等待时间逐次加倍），正在处理的任务以 WorkerCrashed 失败，排队的任务不受影响。
+# 界面进程只在取结果时导入 NumPy，不会导入 deepface / TensorFlow
+
+
+# 工作进程异常退出或任务超时，任务没有完成
+class WorkerCrashed(Exception):
+    pass
+
+
+# 工作进程中抛出的异常，消息中附带工作进程里的 traceback
+class RemoteError(Exception):
+    pass
+
+
+# 健康状态在界面上的显示名称
+WORKER_STATES = {'starting': '启动中', 'ready': '空闲', 'busy': '处理中', 'restarting': '等待重启'}
+
+
+# 把若干数组复制进一块新建的共享内存，返回 (共享内存, 描述)；描述为 (名字, [(键, 形状, dtype, 偏移)])，可以放进管道
+def pack_arrays(arrays):
+    import numpy as np
+    layout, offset = [], 0
+    for key, array in arrays.items():
+        layout.append((key, array.shape, array.dtype.str, offset))
+        offset += (array.nbytes + 63) // 64 * 64  # 每个数组按 64 字节对齐
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for (_, shape, dtype, start), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype, buffer=shm.buf, offset=start)[...] = array
+    return shm, (shm.name, layout)
+
+
+# 从共享内存中取出数组（各复制一份，之后共享内存可以立即释放）；unlink=True 时同时删除共享内存
+def unpack_arrays(packed, unlink=True):
+    import numpy as np
+    name, layout = packed
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        arrays = {key: np.ndarray(shape, dtype, buffer=shm.buf, offset=start).copy()
+                  for key, shape, dtype, start in layout}
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+    return arrays
+
+
+def release_shm(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+# 缩小后的结果图，最长边为 size
+def make_thumbnail(img, size):
+    import cv2
+    height, width = img.shape[:2]
+    scale = size / max(height, width)
+    return cv2.resize(img, (max(1, round(width * scale)), max(1, round(height * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+# 在工作进程中执行一个任务，返回 (结果字典, 要通过共享内存返回的数组)
+#   preload  payload: actions, detector_backend
+#   analyze  payload: path 或输入数组 img, options（AnalysisPipeline 的参数），可选 objs（只重新绘制）、thumbnail（缩略图边长）
+#   save     输入数组 redbox_img / combined_img，payload: output_path, quality
+def run_job(core, kind, payload, arrays, progress):
+    if kind == 'preload':
+        timings = core.modelRegistry.preload(payload['actions'], payload['detector_backend'])
+        return {'timings': core.modelRegistry.timing_text(timings)}, None
+    if kind == 'analyze':
+        objs = payload.get('objs')
+        result = core.AnalysisPipeline(payload.get('path'), img=arrays.get('img'), progress=progress, objs=objs,
+                                       cache=None if objs is not None else True, **payload['options'])
+        out = {key: result.pop(key) for key in ('redbox_img', 'combined_img')}
+        if payload.get('thumbnail'):
+            out['thumbnail'] = make_thumbnail(out['redbox_img'], payload['thumbnail'])
+        return result, out
+    if kind == 'save':
+        redbox_path, combined_path = core.SaveResult(arrays, payload['output_path'], payload['quality'])
+        return {'redbox_path': redbox_path, 'combined_path': combined_path}, None
+    raise ValueError(f"不支持的任务类型: {kind}")
+
+
+# 工作进程入口：导入分析核心后循环处理管道中的任务；cancel 中为要取消的任务编号，在下一个阶段边界生效。
+# 开始处理任务时先发送 started（超时从这里开始计算），每个任务结束时先发送本进程的指标快照（stats）再发送结果
+def worker_main(conn, cancel):
+    try:
+        core = coreLoader.load()
+    except Exception:
+        conn.send(('failed', 0, traceback.format_exc()))
+        return
+    conn.send(('loaded', 0, {'pid': os.getpid(), 'startup': dict(coreLoader.startup)}))
+
+    # 上一个任务导出的共享内存：父进程收到结果时就会复制出来，下一个分析任务到达时再关闭
+    # （Windows 上最后一个句柄关闭时共享内存即被释放，不能在发送结果后立即关闭）
+    exported = []
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None or request[1] != 'preload':
+            for shm in exported:
+                shm.close()
+            exported.clear()
+        if request is None:
+            break
+
+        job_id, kind, payload, packed = request
+
+        def progress(stage, percent):
+            if cancel.value == job_id:
+                raise core.AnalysisCancelled()
+            conn.send(('progress', job_id, (stage, percent)))
+
+        conn.send(('started', job_id, None))
+        try:
+            arrays = unpack_arrays(packed, unlink=False) if packed else {}
+            result, out = run_job(core, kind, payload, arrays, progress)
+            packed_out = None
+            if out:
+                shm, packed_out = pack_arrays(out)
+                exported.append(shm)
+            message = ('done', job_id, (result, packed_out))
+        except core.AnalysisCancelled:
+            message = ('cancelled', job_id, None)
+        except Exception as e:
+            message = ('error', job_id, f"{str(e)}\n{traceback.format_exc()}")
+        # 指标快照先于结果发送，界面收到结果时显示的指标已经包含这个任务
+        conn.send(('stats', job_id, metrics.snapshot()))
+        conn.send(message)
+
+
+# 工作进程池：任务在父进程中排队，空闲的工作进程一次只领取一个任务，
+# 因此排队中的任务可以直接取消，优先任务（界面上的单张分析）可以插到队首。
+# on_event(kind, slot, data) 在监控线程中调用：loaded（分析核心导入完成，data 中 startup 为推理进程的启动耗时）、
+# ready（模型预加载完成，data 为耗时）、
+# failed（导入或预加载失败）、restarted（工作进程已重启，data 为原因）
+class workerPool:
+    def __init__(self, workers=1, job_timeout=None, on_event=None):
+        self.workers = workers
+        self.job_timeout = job_timeout
+        self.on_event = on_event or (lambda kind, slot, data: None)
+        self.ctx = multiprocessing.get_context('spawn')
+        self.lock = threading.RLock()  # Future 的回调会在持有锁时运行，回调中可能再次提交任务
+        self.pending = deque()
+        self.next_job = 0
+        self.preload_args = None
+        self.slots = []
+        self.retired = []  # 已经退出的工作进程最后的指标快照
+        self.closed = False
+        self.monitor = None
+
+    # 启动工作进程和监控线程（spawn 方式，工作进程重新导入模块，不继承界面进程的状态）
+    def start(self):
+        with self.lock:
+            if self.monitor is not None:
+                return
+            self.slots = [self.spawn(slot) for slot in range(self.workers)]
+            self.monitor = threading.Thread(target=self.run, name="worker-pool", daemon=True)
+            self.monitor.start()
+
+    # restarts 为累计重启次数（显示用），failures 为连续失败次数（决定下次重启前的等待时间）
+    def spawn(self, slot, restarts=0, failures=0):
+        conn, child_conn = self.ctx.Pipe()
+        cancel = self.ctx.Value('q', 0, lock=False)
+        process = self.ctx.Process(target=worker_main, args=(child_conn, cancel), name=f"emo-worker-{slot}",
+                                   daemon=True)
+        process.start()
+        child_conn.close()
+        if self.preload_args:
+            conn.send((0, 'preload', self.preload_args, None))
+        return {'process': process, 'conn': conn, 'cancel': cancel, 'state': 'starting', 'job': None,
+                'started': None, 'restarts': restarts, 'failures': failures, 'restart_at': None, 'models': False,
+                'done': 0, 'kill_reason': None, 'metrics': None}
+
+    # 提交任务，返回 Future，结果为结果字典（共享内存中的数组已经复制到结果中）；
+    # arrays 为输入数组，progress(stage, percent) 在监控线程中调用
+    def submit(self, kind, payload, arrays=None, priority=False, progress=None):
+        future = Future()
+        shm, packed = pack_arrays(arrays) if arrays else (None, None)
+        with self.lock:
+            if self.closed:
+                if shm is not None:
+                    release_shm(shm)
+                raise RuntimeError("工作进程池已关闭")
+            self.next_job += 1
+            job = {'id': self.next_job, 'kind': kind, 'payload': payload, 'shm': shm, 'packed': packed,
+                   'future': future, 'progress': progress}
+            if priority:
+                self.pending.appendleft(job)
+            else:
+                self.pending.append(job)
+            self.dispatch()
+        return future
+
+    # 排队中的任务直接取消；正在处理的任务通知工作进程在下一个阶段边界中止，结果为 CancelledError
+    def cancel(self, future):
+        if future.cancel():
+            return True
+        with self.lock:
+            for state in self.slots:
+                if state['job'] is not None and state['job']['future'] is future:
+                    state['cancel'].value = state['job']['id']
+        return False
+
+    # 在所有工作进程（包括之后重启的）中加载并预热模型
+    def preload(self, actions, detector_backend):
+        with self.lock:
+            self.preload_args = {'actions': actions, 'detector_backend': detector_backend}
+            for state in self.slots:
+                if state['state'] != 'restarting':
+                    state['models'] = False
+                    self.send(state, (0, 'preload', self.preload_args, None))
+
+    def health(self):
+        with self.lock:
+            return [{'slot': slot, 'pid': state['process'].pid,
+                     'state': 'busy' if state['job'] is not None else state['state'], 'models': state['models'],
+                     'restarts': state['restarts'], 'jobs': state['done']}
+                    for slot, state in enumerate(self.slots)]
+
+    def health_text(self):
+        return "\n".join(f"推理进程 #{item['slot']} (pid {item['pid']}): {WORKER_STATES[item['state']]}，"
+                         f"完成 {item['jobs']} 个任务，重启 {item['restarts']} 次" for item in self.health())
+
+    # 所有工作进程（包括已经重启掉的）的指标合并后的快照，格式与 metrics.snapshot() 相同
+    def metrics_snapshot(self):
+        with self.lock:
+            return merge_snapshots(self.retired + [state['metrics'] for state in self.slots])
+
+    def ready(self):
+        with self.lock:
+            return any(state['models'] for state in self.slots)
+
+    def close(self, timeout=1.0):
+        with self.lock:
+            self.closed = True
+            for state in self.slots:
+                self.send(state, None)
+            pending, self.pending = list(self.pending), deque()
+        for job in pending:
+            job['future'].cancel()
+            self.release(job)
+        deadline = time.monotonic() + timeout
+        for state in self.slots:
+            state['process'].join(max(0.0, deadline - time.monotonic()))
+            if state['process'].is_alive():
+                state['process'].kill()
+        if self.monitor is not None:
+            self.monitor.join(timeout)
+
+    def send(self, state, message):
+        try:
+            state['conn'].send(message)
+        except (OSError, ValueError):
+            pass  # 工作进程已经退出，由监控线程重启
+
+    def release(self, job):
+        if job['shm'] is not None:
+            release_shm(job['shm'])
+            job['shm'] = None
+
+    # 把排队的任务分给空闲的工作进程（调用时持有锁）；还在导入依赖的进程不领取任务，
+    # 超时从工作进程开始处理任务（started）时计算，排在模型预加载之后等待的时间不计入
+    def dispatch(self):
+        for state in self.slots:
+            if state['job'] is not None or state['state'] != 'ready':
+                continue
+            while self.pending:
+                job = self.pending.popleft()
+                if not job['future'].set_running_or_notify_cancel():
+                    self.release(job)
+                    continue
+                state['job'] = job
+                state['started'] = None
+                self.send(state, (job['id'], job['kind'], job['payload'], job['packed']))
+                break
+
+    # 监控线程：接收各工作进程的消息，检测退出和超时
+    def run(self):
+        while not self.closed:
+            with self.lock:
+                conns = {state['conn']: slot for slot, state in enumerate(self.slots)
+                         if state['state'] != 'restarting'}
+            for conn in wait(list(conns), timeout=0.5):
+                slot = conns[conn]
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    if not self.closed:
+                        state = self.slots[slot]
+                        state['process'].join(0.5)
+                        self.restart(slot, state['kill_reason'] or f"退出码 {state['process'].exitcode}")
+                    continue
+                self.handle(slot, *message)
+            self.check()
+
+    def handle(self, slot, kind, job_id, data):
+        with self.lock:
+            state = self.slots[slot]
+            job = state['job'] if state['job'] is not None and state['job']['id'] == job_id else None
+            if kind == 'loaded':
+                state['state'] = 'ready'
+                self.dispatch()
+            elif kind == 'stats':
+                state['metrics'] = data
+                return
+            elif kind == 'started':
+                if job is not None:
+                    state['started'] = time.monotonic()
+                return
+            elif kind == 'progress':
+                if job is not None and job['progress']:
+                    job['progress'](*data)
+                return
+            elif job_id == 0:
+                # 预加载任务
+                if kind == 'done':
+                    state['models'] = True
+                    state['failures'] = 0  # 成功完成任务后重新计算退避时间，偶发的崩溃不会越积越久
+                    data = data[0]['timings']
+                else:
+                    kind = 'failed'
+            elif job is None:
+                # 已经按崩溃处理过的旧任务，只释放它的共享内存
+                if kind == 'done' and data[1]:
+                    try:
+                        release_shm(shared_memory.SharedMemory(name=data[1][0]))
+                    except FileNotFoundError:
+                        pass
+                return
+            else:
+                state['job'] = None
+                state['done'] += 1
+                if kind == 'done':
+                    state['failures'] = 0
+                state['cancel'].value = 0
+                self.release(job)
+                if kind == 'done':
+                    result, packed = data
+                    try:
+                        if packed:
+                            result.update(unpack_arrays(packed))
+                    except Exception as e:
+                        job['future'].set_exception(e)
+                    else:
+                        job['future'].set_result(result)
+                elif kind == 'cancelled':
+                    job['future'].set_exception(CancelledError())
+                else:
+                    job['future'].set_exception(RemoteError(data))
+                self.dispatch()
+                return
+        self.on_event(kind, slot, data)
+
+    # 工作进程退出：正在处理的任务失败，按退避时间重启
+    def restart(self, slot, reason):
+        with self.lock:
+            state = self.slots[slot]
+            state['conn'].close()
+            state['process'].join(0.5)
+            if state['process'].is_alive():
+                state['process'].kill()
+            job, state['job'] = state['job'], None
+            state['state'] = 'restarting'
+            state['models'] = False
+            state['restart_at'] = time.monotonic() + min(2 ** state['failures'] - 1, 30)
+            if job is not None:
+                self.release(job)
+                job['future'].set_exception(WorkerCrashed(f"推理进程异常退出（{reason}），已自动重启"))
+        self.on_event('restarted', slot, reason)
+
+    def check(self):
+        now = time.monotonic()
+        with self.lock:
+            for slot, state in enumerate(self.slots):
+                if state['state'] == 'restarting' and now >= state['restart_at']:
+                    if state['metrics']:
+                        self.retired.append(state['metrics'])
+                    self.slots[slot] = self.spawn(slot, state['restarts'] + 1, state['failures'] + 1)
+                    self.dispatch()
+                elif self.job_timeout and state['job'] is not None and state['started'] is not None and \
+                        now - state['started'] > self.job_timeout:
+                    # 推理本身无法中断，超时后直接结束进程，由 run() 按退出处理
+                    state['kill_reason'] = f"任务超过 {self.job_timeout:.0f}s 没有完成"
+                    state['process'].kill()
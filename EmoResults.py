@@ -0,0 +1,156 @@
+import json
+import os
+
+import numpy as np
+
+# 各属性模型输出的标签顺序（与 DeepFace 保持一致）
+EMOTION_LABELS = ['angry', 'disgust', 'fear', 'happy', 'sad', 'surprise', 'neutral']
+GENDER_LABELS = ['Woman', 'Man']
+RACE_LABELS = ['asian', 'indian', 'black', 'white', 'middle eastern', 'latino hispanic']
+
+# 概率矩阵列 -> 标签表
+PROBABILITY_FIELDS = {'emotion': EMOTION_LABELS, 'gender': GENDER_LABELS, 'race': RACE_LABELS}
+
+
+# 一组人脸的分析结果，按列存放（struct-of-arrays）：
+#   boxes       int32   N x 4     x, y, w, h（原图坐标）
+#   confidence  float32 N         人脸检测置信度
+#   emotion / gender / race  float32 N x 标签数，百分比，列顺序见 PROBABILITY_FIELDS；没有分析的属性为 None
+#   age         float32 N
+#   identity / identity_distance  使用身份索引时才有
+# 大量结果只占几个连续数组，可以切片、拼接，并以 .npy 目录的形式零拷贝保存和映射读取；
+# 需要旧的 DeepFace 字典结构时用 to_objs() 转换
+class faceResults:
+    ARRAYS = ('boxes', 'confidence', 'emotion', 'gender', 'race', 'age', 'identity_distance')
+
+    def __init__(self, boxes, confidence=None, emotion=None, gender=None, race=None, age=None, identity=None,
+                 identity_distance=None):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        count = len(self.boxes)
+        self.confidence = np.zeros(count, dtype=np.float32) if confidence is None else \
+            np.asarray(confidence, dtype=np.float32)
+        self.emotion = None if emotion is None else np.asarray(emotion, dtype=np.float32)
+        self.gender = None if gender is None else np.asarray(gender, dtype=np.float32)
+        self.race = None if race is None else np.asarray(race, dtype=np.float32)
+        self.age = None if age is None else np.asarray(age, dtype=np.float32)
+        self.identity = None if identity is None else list(identity)
+        self.identity_distance = None if identity_distance is None else \
+            np.asarray(identity_distance, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.boxes)
+
+    # 空结果：各属性按 actions 预先分配好矩阵，推理时按行写入
+    @classmethod
+    def empty(cls, count, actions=()):
+        arrays = {field: np.zeros((count, len(labels)), dtype=np.float32)
+                  for field, labels in PROBABILITY_FIELDS.items() if field in actions}
+        if 'age' in actions:
+            arrays['age'] = np.zeros(count, dtype=np.float32)
+        return cls(np.zeros((count, 4), dtype=np.int32), **arrays)
+
+    # 切片 / 花式索引，返回新的 faceResults（numpy 切片时不复制数据）
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            index = slice(index, index + 1)
+        values = {field: None if getattr(self, field) is None else getattr(self, field)[index]
+                  for field in self.ARRAYS}
+        if self.identity is not None:
+            values['identity'] = list(np.asarray(self.identity, dtype=object)[index])
+        return faceResults(**values)
+
+    @classmethod
+    def concat(cls, parts):
+        parts = [part for part in parts if len(part)]
+        if not parts:
+            return cls(np.zeros((0, 4), dtype=np.int32))
+        values = {}
+        for field in cls.ARRAYS:
+            arrays = [getattr(part, field) for part in parts]
+            values[field] = None if any(array is None for array in arrays) else np.concatenate(arrays)
+        if all(part.identity is not None for part in parts):
+            values['identity'] = [identity for part in parts for identity in part.identity]
+        return cls(**values)
+
+    def dominant(self, field):
+        matrix = getattr(self, field)
+        if matrix is None:
+            return None
+        return [PROBABILITY_FIELDS[field][index] for index in np.argmax(matrix, axis=1)]
+
+    # 从 DeepFace / predict_batch 的字典结构转换（缺失的属性整列为 None）
+    @classmethod
+    def from_objs(cls, objs):
+        boxes = [[obj['region'][key] for key in ('x', 'y', 'w', 'h')] for obj in objs]
+        values = {'confidence': [obj.get('face_confidence', 0) for obj in objs]}
+        for field, labels in PROBABILITY_FIELDS.items():
+            if objs and all(field in obj for obj in objs):
+                values[field] = [[obj[field][label] for label in labels] for obj in objs]
+        if objs and all('age' in obj for obj in objs):
+            values['age'] = [obj['age'] for obj in objs]
+        if objs and all('identity' in obj for obj in objs):
+            values['identity'] = [obj['identity'] for obj in objs]
+            values['identity_distance'] = [np.nan if obj['identity_distance'] is None else obj['identity_distance']
+                                           for obj in objs]
+        return cls(boxes, **values)
+
+    # 转换为与 DeepFace.analyze 相同结构的字典列表，数值都是 Python 内置类型
+    def to_objs(self):
+        objs = [{'region': dict(zip(('x', 'y', 'w', 'h'), box)), 'face_confidence': confidence}
+                for box, confidence in zip(self.boxes.tolist(), self.confidence.tolist())]
+        if self.age is not None:
+            for obj, age in zip(objs, self.age.tolist()):
+                obj['age'] = int(age)
+        for field, labels in PROBABILITY_FIELDS.items():
+            matrix = getattr(self, field)
+            if matrix is None:
+                continue
+            for obj, row, dominant in zip(objs, matrix.tolist(), self.dominant(field)):
+                obj[field] = dict(zip(labels, row))
+                obj[f"dominant_{field}"] = dominant
+        if self.identity is not None:
+            for obj, identity, distance in zip(objs, self.identity, self.identity_distance.tolist()):
+                obj['identity'] = identity
+                obj['identity_distance'] = None if np.isnan(distance) else distance
+        return objs
+
+    # 保存为目录：每个数组一个 .npy 文件，meta.json 记录标签表和身份列表
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        fields = [field for field in self.ARRAYS if getattr(self, field) is not None]
+        for field in fields:
+            np.save(os.path.join(path, f"{field}.npy"), getattr(self, field))
+        meta = {'count': len(self), 'fields': fields, 'labels': PROBABILITY_FIELDS, 'identity': self.identity}
+        with open(os.path.join(path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        return path
+
+    # mmap=True 时数组直接映射文件，不读入内存
+    @classmethod
+    def load(cls, path, mmap=True):
+        with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        values = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode='r' if mmap else None)
+                  for field in meta['fields']}
+        return cls(identity=meta['identity'], **values)
+
+    # 转为 pyarrow.Table（需要另外安装 pyarrow），概率矩阵展开为 emotion_angry 等列
+    def to_arrow(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("to_arrow 需要安装 pyarrow: pip install pyarrow")
+
+        columns = {name: np.ascontiguousarray(self.boxes[:, i]) for i, name in enumerate(('x', 'y', 'w', 'h'))}
+        columns['face_confidence'] = self.confidence
+        for field, labels in PROBABILITY_FIELDS.items():
+            matrix = getattr(self, field)
+            if matrix is not None:
+                columns.update({f"{field}_{label}": np.ascontiguousarray(matrix[:, i])
+                                for i, label in enumerate(labels)})
+        if self.age is not None:
+            columns['age'] = self.age
+        if self.identity is not None:
+            columns['identity'] = self.identity
+            columns['identity_distance'] = self.identity_distance
+        return pa.table(columns)
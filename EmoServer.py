@@ -0,0 +1,224 @@
+import argparse
+import base64
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import Flask, jsonify, request
+
+import deepface
+from EmoAna import deepAnalysis, modelRegistry, ACTION_PROFILES, DEFAULT_DETECTOR
+from EmoCache import resultCache
+from EmoMetrics import metrics, stageTimer
+
+# 本地 HTTP 推理服务：模型在进程内只加载一次，多个客户端共享同一套已预热的模型。
+# 检测在请求线程中进行，短时间窗口内到达的请求的人脸由 microBatcher 合并成一次前向计算。
+#   POST /analyze  上传图片（multipart 字段 image）或直接把图片字节作为请求体
+#   GET  /health   进程存活
+#   GET  /ready    默认模型已加载并预热
+#   GET  /metrics  计数器、耗时直方图和缓存统计
+
+
+# 服务繁忙（并发或排队已满），对应 HTTP 503
+class ServerBusy(Exception):
+    pass
+
+
+# 微批处理：请求线程提交各自的人脸，后台线程在 max_wait_ms 内尽量凑满 max_batch 张人脸后统一推理，
+# 再按提交顺序把结果拆回各个请求；排队的请求超过 max_pending 时直接拒绝，而不是无限堆积
+class microBatcher:
+    def __init__(self, actions, max_batch=32, max_wait_ms=10, max_pending=64):
+        self.actions = deepAnalysis.resolve_actions(actions)
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, face_objs, timeout=60):
+        future = Future()
+        try:
+            self.queue.put_nowait((face_objs, future))
+        except queue.Full:
+            metrics.inc('server_rejected_queue_full')
+            raise ServerBusy("推理队列已满，请稍后重试")
+        return future.result(timeout=timeout)
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            faces = len(jobs[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while faces < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                faces += len(job[0])
+
+            try:
+                objs = deepAnalysis.predict_batch([face for face_objs, _ in jobs for face in face_objs], self.actions,
+                                                  timer=stageTimer())
+            except Exception as e:
+                for _, future in jobs:
+                    future.set_exception(e)
+                continue
+
+            metrics.inc('server_batches')
+            metrics.inc('server_batched_requests', len(jobs))
+            offset = 0
+            for face_objs, future in jobs:
+                future.set_result(objs[offset:offset + len(face_objs)])
+                offset += len(face_objs)
+
+
+def encode_b64(img, ext):
+    return base64.b64encode(deepAnalysis.encode_img(img, ext).tobytes()).decode('ascii')
+
+
+def create_app(actions='emotion-only', detector_backend=DEFAULT_DETECTOR, align=True, detect_max_side=1280,
+               max_concurrent=8, max_batch=32, max_wait_ms=10, max_pending=64, max_upload_mb=20, cache=True,
+               max_side=None):
+    app = Flask(__name__)
+    app.config['MAX_CONTENT_LENGTH'] = max_upload_mb * 1024 * 1024
+
+    default_actions = deepAnalysis.resolve_actions(actions)
+    cache = resultCache.default() if cache is True else cache
+    # 同时处理（解码 + 检测 + 等待推理）的请求数上限，超出时立即返回 503
+    slots = threading.BoundedSemaphore(max_concurrent)
+    batchers = {}
+    batchers_lock = threading.Lock()
+
+    def get_batcher(actions):
+        key = tuple(actions)
+        with batchers_lock:
+            if key not in batchers:
+                batchers[key] = microBatcher(actions, max_batch, max_wait_ms, max_pending)
+            return batchers[key]
+
+    def error(status, message):
+        response = jsonify({'error': message})
+        response.status_code = status
+        if status == 503:
+            response.headers['Retry-After'] = '1'
+        return response
+
+    # 启动时在后台加载并预热默认模型，/ready 在完成前返回 503
+    modelRegistry.preload_async(default_actions, detector_backend=detector_backend)
+
+    @app.route('/health')
+    def health():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/ready')
+    def ready():
+        if modelRegistry.is_ready(default_actions, detector_backend):
+            return jsonify({'status': 'ready', 'actions': default_actions, 'detector_backend': detector_backend,
+                            'timings': modelRegistry.timings})
+        return error(503, "模型加载中")
+
+    @app.route('/metrics')
+    def metrics_view():
+        snapshot = metrics.snapshot()
+        if cache:
+            snapshot['cache'] = dict(cache.stats)
+        return jsonify(snapshot)
+
+    # 参数：actions=分析模式（ACTION_PROFILES 中的名称），render=png|jpg 时附带 base64 编码的结果图
+    @app.route('/analyze', methods=['POST'])
+    def analyze():
+        if not slots.acquire(blocking=False):
+            metrics.inc('server_rejected_busy')
+            return error(503, "并发请求过多，请稍后重试")
+        try:
+            metrics.inc('server_requests')
+            upload = request.files.get('image')
+            data = upload.read() if upload else request.get_data()
+            if not data:
+                return error(400, "请求中没有图片（multipart 字段 image 或请求体）")
+
+            profile = request.args.get('actions')
+            if profile and profile not in ACTION_PROFILES:
+                return error(400, f"不支持的分析模式: {profile}")
+            actions = deepAnalysis.resolve_actions(profile) if profile else default_actions
+            render = request.args.get('render')
+            if render and render not in ('png', 'jpg'):
+                return error(400, f"不支持的图片格式: {render}")
+
+            timer = stageTimer()
+            try:
+                # max_side 为分析分辨率上限，大图在解码时就缩小；返回的人脸框仍是原图坐标
+                img, scale = deepAnalysis.decode_img(data, max_side, timer)
+            except ValueError:
+                return error(400, "无法解码图片")
+
+            objs = None
+            if cache:
+                key = cache.make_key(data, actions, deepface.__version__, detector_backend, align, detect_max_side,
+                                     max_side)
+                objs = cache.get(key)
+            cached = objs is not None
+            if not cached:
+                try:
+                    with timer.span('detect'):
+                        face_objs = deepAnalysis.detect_faces(img, detector_backend=detector_backend, align=align,
+                                                              detect_max_side=detect_max_side,
+                                                              enforce_detection=True)
+                except ValueError as e:
+                    return error(422, str(e))
+                face_objs = [face for face in face_objs if face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+                for face in face_objs:
+                    face['facial_area'] = deepAnalysis.scale_region(face['facial_area'], scale)
+                with timer.span('infer'):
+                    objs = get_batcher(actions).submit(face_objs)
+                objs = deepAnalysis.to_builtin(objs)
+                if cache:
+                    cache.put(key, objs)
+
+            summary, emotion_text = deepAnalysis.parse_deepface_result(objs)
+            body = {'summary': summary, 'emotion_text': emotion_text, 'faces': objs, 'cached': cached}
+            if render:
+                with timer.span('render'):
+                    img_with_box = deepAnalysis.draw_red_box(img, objs, scale)
+                    combined_img = deepAnalysis.draw_Ana_img(img_with_box, objs)
+                    body['images'] = {'format': render, 'redbox': encode_b64(img_with_box, f".{render}"),
+                                      'combined': encode_b64(combined_img, f".{render}")}
+            body['timings'] = timer.spans
+            return jsonify(body)
+        except ServerBusy as e:
+            return error(503, str(e))
+        except Exception as e:
+            metrics.inc('server_errors')
+            return error(500, str(e))
+        finally:
+            slots.release()
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="EmoAna 本地 HTTP 推理服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--actions', default='emotion-only', choices=list(ACTION_PROFILES), help="默认分析模式")
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR, help="DeepFace 人脸检测后端")
+    parser.add_argument('--no-align', action='store_true', help="关闭人脸对齐")
+    parser.add_argument('--detect-max-side', type=int, default=1280, help="检测前把图片缩小到的最长边")
+    parser.add_argument('--max-side', type=int, help="分析分辨率上限，大图在解码时就缩小")
+    parser.add_argument('--max-concurrent', type=int, default=8, help="同时处理的请求数上限")
+    parser.add_argument('--max-batch', type=int, default=32, help="每次前向推理的最大人脸数")
+    parser.add_argument('--max-wait-ms', type=int, default=10, help="凑批的最长等待时间")
+    parser.add_argument('--max-pending', type=int, default=64, help="等待推理的请求数上限")
+    parser.add_argument('--no-cache', action='store_true', help="不使用结果缓存")
+    args = parser.parse_args()
+
+    app = create_app(args.actions, args.detector, not args.no_align, args.detect_max_side, args.max_concurrent,
+                     args.max_batch, args.max_wait_ms, args.max_pending, cache=not args.no_cache,
+                     max_side=args.max_side)
+    # 模型在进程内共享，用多线程而不是多进程提供服务
+    app.run(host=args.host, port=args.port, threaded=True)
@@ -1,15 +1,48 @@
 import sys
 import os
+import threading
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog, QGraphicsScene
-from PyQt5.QtGui import QPixmap, QImage
+from PyQt5.QtGui import QPixmap, QImage, QImageReader
+from PyQt5.QtCore import QThread, pyqtSignal
 from EmoR import Ui_Dialog
-from EmoAna import Analysis
+# deepface / TensorFlow / cv2 / NumPy 很慢，窗口显示后再通过 coreLoader 在后台导入 EmoAna
+from EmoOptions import ACTION_PROFILES, DETECTOR_BACKENDS, DEFAULT_MAX_SIDE, coreLoader
+from EmoMetrics import metrics, timings_text
 
+# 分析模式下拉框的显示名称，界面默认只跑情绪和性别两个模型
+PROFILE_NAMES = {
+    'emotion+gender': '情绪+性别',
+    'emotion-only': '仅情绪',
+    'full': '完整分析',
+}
 
 
+class ModelLoader(QThread):
+    """Import the analysis core, then preload and warm up the models in the background while the window opens"""
+    coreReady = pyqtSignal()
+    modelsReady = pyqtSignal(str)
+    modelsError = pyqtSignal(str)
+
+    def __init__(self, actions, detector_backend):
+        super().__init__()
+        self.actions = actions
+        self.detector_backend = detector_backend
+
+    def run(self):
+        try:
+            core = coreLoader.load()
+            self.coreReady.emit()
+            timings = core.modelRegistry.preload(self.actions, self.detector_backend)
+            coreLoader.mark('models_ready')
+            self.modelsReady.emit(core.modelRegistry.timing_text(timings))
+        except Exception as e:
+            self.modelsError.emit(str(e))
+
 
 class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
+    saveFinished = pyqtSignal(str)
+
     def __init__(self):
         super().__init__()
 
@@ -18,12 +51,85 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
 
         # Initialize variables
         self.or_emo_path = ""
-        self.combined_img_path = ""
+        self.result = None
+        self.result_qimage = None
+        self.loader = None
+
+        # Analysis mode selector, placed above the "start detection" button
+        self.action_box = QtWidgets.QComboBox(self)
+        for profile, name in PROFILE_NAMES.items():
+            if profile in ACTION_PROFILES:
+                self.action_box.addItem(name, profile)
+        self.verticalLayout.insertWidget(2, self.action_box, 0, QtCore.Qt.AlignHCenter)
+
+        # Face detector backend and alignment switch
+        self.detector_box = QtWidgets.QComboBox(self)
+        self.detector_box.addItems(DETECTOR_BACKENDS)
+        self.verticalLayout.insertWidget(3, self.detector_box, 0, QtCore.Qt.AlignHCenter)
+        self.align_check = QtWidgets.QCheckBox("人脸对齐", self)
+        self.align_check.setChecked(True)
+        self.verticalLayout.insertWidget(4, self.align_check, 0, QtCore.Qt.AlignHCenter)
+
+        # Model status
+        self.status_label = QtWidgets.QLabel("正在加载依赖...", self)
+        self.status_label.setWordWrap(True)
+        self.verticalLayout.addWidget(self.status_label)
+
+        # "Start detection" stays disabled until the background import of the analysis core has finished,
+        # so clicking early never blocks the GUI thread on the loader
+        self.pushButton_2.setEnabled(False)
 
         # Connect buttons to functions
         self.pushButton.clicked.connect(self.upload_image)
         self.pushButton_2.clicked.connect(self.start_detection)
         self.pushButton_3.clicked.connect(self.save_result)
+        self.saveFinished.connect(self.handle_save_finished)
+        self.action_box.currentIndexChanged.connect(self.preload_models)
+        self.detector_box.currentIndexChanged.connect(self.preload_models)
+
+        # Import the analysis core and load the models in the background once the window is shown
+        QtCore.QTimer.singleShot(0, self.start_background)
+
+    def start_background(self):
+        """Runs once the window is up: record the startup time and start the background import"""
+        coreLoader.mark('window')
+        self.preload_models()
+
+    def preload_models(self):
+        """Import the core if needed, then load and warm up the models needed by the selected analysis mode"""
+        options = self.analysis_options()
+        core = coreLoader.loaded()
+        if core and core.modelRegistry.is_ready(options['actions'], options['detector_backend']):
+            self.status_label.setText(f"模型已就绪 ({core.modelRegistry.timing_text()})")
+            return
+        if self.loader and self.loader.isRunning():
+            return
+
+        self.status_label.setText("模型加载中..." if core else "正在加载依赖...")
+        self.loader = ModelLoader(options['actions'], options['detector_backend'])
+        self.loader.coreReady.connect(self.handle_core_ready)
+        self.loader.modelsReady.connect(self.handle_models_ready)
+        self.loader.modelsError.connect(lambda message: self.status_label.setText(f"模型加载失败: {message}"))
+        self.loader.start()
+
+    def analysis_options(self):
+        """Analysis parameters selected in the UI"""
+        return {
+            'actions': self.action_box.currentData(),
+            'detector_backend': self.detector_box.currentText(),
+            'align': self.align_check.isChecked(),
+            'max_side': DEFAULT_MAX_SIDE,
+            'detect_max_side': 1280,
+        }
+
+    def handle_core_ready(self):
+        self.status_label.setText("模型加载中...")
+        self.pushButton_2.setEnabled(True)
+
+    def handle_models_ready(self, timing_text):
+        self.status_label.setText(f"模型已就绪 ({timing_text})")
+        self.status_label.setToolTip(f"启动耗时: {coreLoader.startup_text()}")
+        self.preload_models()
 
     def upload_image(self):
         """Open file dialog and load selected image"""
@@ -35,6 +141,7 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
 
         if file_name:
             self.or_emo_path = file_name
+            self.result = None
             self.display_image(self.or_emo_path, self.org_img)
             self.summary.clear()
             self.text2.clear()
@@ -42,30 +149,88 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
             self.combined_img.setScene(scene)
 
     def display_image(self, image_path, graphics_view):
+        """Apply the EXIF orientation like the OpenCV decode does, and decode large images at reduced size"""
+        reader = QImageReader(image_path)
+        reader.setAutoTransform(True)
+        size = reader.size()
+        if size.isValid() and max(size.width(), size.height()) > DEFAULT_MAX_SIDE:
+            reader.setScaledSize(size.scaled(DEFAULT_MAX_SIDE, DEFAULT_MAX_SIDE, QtCore.Qt.KeepAspectRatio))
+        pixmap = QPixmap.fromImage(reader.read())
+        scene = QGraphicsScene()
+        scene.addPixmap(pixmap)
+        graphics_view.setScene(scene)
+        graphics_view.fitInView(scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
 
-        pixmap = QPixmap(image_path)
+    def display_array(self, img, graphics_view):
+        """Show an in-memory BGR array; the QImage shares the array's memory"""
+        import numpy as np  # already imported by the analysis core at this point
+        img = np.ascontiguousarray(img)
+        height, width = img.shape[:2]
+        self.result_qimage = (img, QImage(img.data, width, height, img.strides[0], QImage.Format_BGR888))
+        pixmap = QPixmap.fromImage(self.result_qimage[1])
         scene = QGraphicsScene()
         scene.addPixmap(pixmap)
         graphics_view.setScene(scene)
         graphics_view.fitInView(scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
 
+    def timing_status(self, result):
+        """Per-stage timings of the last analysis for the status label"""
+        if result['cached']:
+            return f"命中缓存 ({timings_text(result['timings'])})"
+        return f"本次耗时: {timings_text(result['timings'])}"
+
     def start_detection(self):
 
 
-        # Call your analysis function
-        summary_text, emotion_text, redbox_path, self.combined_img_path = Analysis(self.or_emo_path)
+        core = coreLoader.loaded()
+        if core is None:
+            return  # the button is only enabled once the core is imported
+
+        # Call your analysis function; rendered images stay in memory until saved
+        self.result = core.AnalysisPipeline(self.or_emo_path, **self.analysis_options())
         # Display results
-        self.summary.setText(summary_text)
-        self.text2.setText(emotion_text)
-        self.display_image(self.combined_img_path, self.combined_img)
+        self.summary.setText(self.result['summary'])
+        self.text2.setText(self.result['emotion_text'])
+        self.display_array(self.result['combined_img'], self.combined_img)
+        self.status_label.setText(self.timing_status(self.result))
+        self.status_label.setToolTip(metrics.summary_text())
 
 
 
     def save_result(self):
+        """Ask for a path/format and write the result images in a background thread"""
+        if self.result is None:
+            return
 
+        base_name, _ = os.path.splitext(self.or_emo_path)
+        file_name, _ = QFileDialog.getSaveFileName(
+            self, "保存结果", f"{base_name}_analyzed.png",
+            "PNG 图片 (*.png);;JPEG 图片 (*.jpg *.jpeg);;WebP 图片 (*.webp)"
+        )
+        if not file_name:
+            return
+
+        quality = 95
+        if os.path.splitext(file_name)[1].lower() in ('.jpg', '.jpeg', '.webp'):
+            quality, ok = QtWidgets.QInputDialog.getInt(self, "图片质量", "质量 (1-100):", 95, 1, 100)
+            if not ok:
+                return
+
+        result = self.result
+
+        def write():
+            try:
+                _, combined_path = coreLoader.load().SaveResult(result, file_name, quality)
+                self.saveFinished.emit(f"图片已保存到: {combined_path}")
+            except Exception as e:
+                self.saveFinished.emit(f"保存失败: {e}")
+
+        threading.Thread(target=write, daemon=True).start()
+
+    def handle_save_finished(self, message):
         # Simply display the path in the summary text box
         self.summary.append("--------------")
-        self.summary.append(f"图片已保存到: {self.combined_img_path}")
+        self.summary.append(message)
         self.summary.append("--------------")
 
     def resizeEvent(self, event):
@@ -77,10 +242,17 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
             if self.org_img.scene():
                 self.org_img.fitInView(self.org_img.scene().sceneRect(), QtCore.Qt.KeepAspectRatio)
 
-        if hasattr(self, 'combined_img_path') and self.combined_img_path:
+        if getattr(self, 'result', None) is not None:
             if self.combined_img.scene():
                 self.combined_img.fitInView(self.combined_img.scene().sceneRect(), QtCore.Qt.KeepAspectRatio)
 
+    def closeEvent(self, event):
+        """The background import / model loading cannot be interrupted; hide the window and let it finish"""
+        if self.loader and self.loader.isRunning():
+            self.hide()
+            self.loader.wait()
+        event.accept()
+
 
 if __name__ == "__main__":
     app = QtWidgets.QApplication(sys.argv)
@@ -1,37 +1,205 @@
 import sys
 import os
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError
 from PyQt5 import QtCore, QtGui, QtWidgets
 from PyQt5.QtWidgets import QFileDialog, QGraphicsScene, QMessageBox
-from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtCore import QThread, pyqtSignal, pyqtSlot
+from PyQt5.QtGui import QPixmap, QImage, QImageReader
+from PyQt5.QtCore import pyqtSignal, pyqtSlot
 from EmoR import Ui_Dialog
-from EmoAna import Analysis
+# deepface / TensorFlow / cv2 很慢，只在推理进程中导入 EmoAna，界面进程不加载模型
+from EmoOptions import ACTION_PROFILES, DETECTOR_BACKENDS, DEFAULT_MAX_SIDE, coreLoader, iter_images
+from EmoMetrics import metrics, timings_text, merge_snapshots, snapshot_text
+from EmoProcess import workerPool
 import traceback
 
+# 分析模式下拉框的显示名称，界面默认只跑情绪和性别两个模型
+PROFILE_NAMES = {
+    'emotion+gender': '情绪+性别',
+    'emotion-only': '仅情绪',
+    'full': '完整分析',
+}
 
-class AnalysisWorker(QThread):
-    """工作线程类，处理耗时的分析工作"""
+# 各分析阶段在界面上的显示名称
+STAGE_NAMES = {'decode': '读取图片', 'inference': '模型推理', 'render': '绘制结果', 'done': '完成'}
+
+# 多图列表的缩略图边长；缩略图很小可以多缓存一些，完整结果带两张原尺寸的结果图，只保留最近的几张
+THUMBNAIL_SIZE = 96
+THUMBNAIL_CACHE_SIZE = 512
+RESULT_CACHE_SIZE = 16
+# 推理进程数：每个进程各自加载一份模型（内存占用成倍增加），核数较多时才用两个进程并行分析多图
+INFERENCE_PROCESSES = 2 if (os.cpu_count() or 1) >= 4 else 1
+# 单个任务的超时时间（秒），超时后结束推理进程并自动重启
+JOB_TIMEOUT = 180
+
+
+class lruCache:
+    """线程安全的定长 LRU 缓存，超出容量时丢弃最久没有用到的条目"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class AnalysisWorker(QtCore.QObject):
+    """单张分析：任务交给推理进程池（排在多图任务之前），结果通过信号回到界面线程。
+    新任务提交后，之前尚未完成的分析任务都会作废，正在执行的任务在下一个阶段边界取消"""
     # 定义信号
-    analysisComplete = pyqtSignal(str, str, str,
-                                  str)  # 分析完成信号(summary_text, emotion_text, redbox_path, combined_img_path)
-    analysisError = pyqtSignal(str)  # 错误信号
+    analysisComplete = pyqtSignal(int, object)  # 分析完成信号(job_id, 结果字典，包含渲染好的图片数组)
+    analysisError = pyqtSignal(int, str)  # 错误信号(job_id, 错误信息)
+    analysisProgress = pyqtSignal(int, int, str)  # 进度信号(job_id, 百分比, 阶段)
+    analysisCancelled = pyqtSignal(int)  # 取消信号(job_id)
 
-    def __init__(self, image_path):
+    def __init__(self, pool):
         super().__init__()
-        self.image_path = image_path
+        self.pool = pool
+        self.latest_job = 0  # 只有编号等于它的分析任务才是有效的
+        self.future = None
 
-    def run(self):
-        """线程执行的主要任务"""
-        try:
-            # 在这里调用分析函数
-            summary_text, emotion_text, redbox_path, combined_img_path = Analysis(self.image_path)
-            self.analysisComplete.emit(summary_text, emotion_text, redbox_path, combined_img_path)
-        except Exception as e:
-            error_info = f"分析过程出错: {str(e)}\n{traceback.format_exc()}"
-            self.analysisError.emit(error_info)
+    def submit(self, image_path, options):
+        """提交分析任务，options 为 AnalysisPipeline 的参数（分析模式、检测后端等），返回任务编号；
+        之前的分析任务全部作废"""
+        self.cancel()
+        job_id = self.latest_job
+        self.future = self.pool.submit(
+            'analyze', {'path': image_path, 'options': options}, priority=True,
+            progress=lambda stage, percent: self.analysisProgress.emit(job_id, percent, stage))
+        self.future.add_done_callback(lambda future: self.finish(job_id, future))
+        return job_id
+
+    def cancel(self):
+        """取消尚未完成的分析任务"""
+        self.latest_job += 1
+        if self.future is not None:
+            self.pool.cancel(self.future)
+            self.future = None
+
+    def finish(self, job_id, future):
+        """任务结束（在进程池的监控线程中调用），通过信号回到界面线程"""
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled() or isinstance(error, CancelledError):
+            self.analysisCancelled.emit(job_id)
+        elif error is not None:
+            self.analysisError.emit(job_id, f"分析过程出错: {str(error)}")
+        else:
+            self.analysisComplete.emit(job_id, future.result())
+
+
+class BatchRunner(QtCore.QObject):
+    """多图分析：图片交给推理进程池并行分析，缩略图也在推理进程中生成，结果通过信号回到界面线程。
+    新批次开始或取消后，旧批次中还在排队的图片直接丢弃，正在分析的在下一个阶段边界取消"""
+    itemComplete = pyqtSignal(int, int, object)  # 单张完成信号(批次, 序号, 结果字典，另带 thumbnail 缩略图 QImage)
+    itemError = pyqtSignal(int, int, str)  # 单张出错信号(批次, 序号, 错误信息)
+    renderComplete = pyqtSignal(int, int, object)  # 重新绘制完成信号(批次, 序号, 结果字典)
+    renderError = pyqtSignal(int, int, str)  # 重新绘制出错信号(批次, 序号, 错误信息)
+
+    def __init__(self, pool):
+        super().__init__()
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.batch_id = 0  # 只有编号等于它的批次才是有效的
+        self.futures = set()  # 还没有结束的任务，取消时逐个通知进程池
+        self.thumbnails = lruCache(THUMBNAIL_CACHE_SIZE)
+
+    def start(self, paths, options):
+        """提交一批图片，options 为 AnalysisPipeline 的参数，返回批次编号；之前的批次作废"""
+        self.cancel()
+        with self.lock:
+            batch_id = self.batch_id
+        for index, path in enumerate(paths):
+            key = (path, tuple(sorted(options.items())))
+            payload = {'path': path, 'options': options}
+            if self.thumbnails.get(key) is None:
+                payload['thumbnail'] = THUMBNAIL_SIZE
+            self.track(self.pool.submit('analyze', payload),
+                       lambda future, index=index, path=path, key=key: self.analysed(batch_id, index, path, key,
+                                                                                     future))
+        return batch_id
+
+    def render(self, batch_id, index, path, objs, options):
+        """用已有的分析结果重新绘制结果图（不检测也不推理），用于结果图已经被挤出缓存的图片"""
+        future = self.pool.submit('analyze', {'path': path, 'options': options, 'objs': objs}, priority=True)
+        self.track(future, lambda future: self.rendered(batch_id, index, path, future))
+
+    def cancel(self):
+        """取消当前批次中尚未完成的图片"""
+        with self.lock:
+            self.batch_id += 1
+            futures, self.futures = list(self.futures), set()
+        for future in futures:
+            self.pool.cancel(future)
+
+    def is_stale(self, batch_id):
+        with self.lock:
+            return batch_id != self.batch_id
+
+    def track(self, future, callback):
+        with self.lock:
+            self.futures.add(future)
+
+        def done(future):
+            with self.lock:
+                self.futures.discard(future)
+            callback(future)
+        future.add_done_callback(done)
+
+    def analysed(self, batch_id, index, path, key, future):
+        # 批次已经作废时（包括取消）不再报告
+        if future.cancelled() or self.is_stale(batch_id):
+            return
+        error = future.exception()
+        if error is not None:
+            if not isinstance(error, CancelledError):
+                self.itemError.emit(batch_id, index, f"{path}: {str(error)}")
+            return
+        result = future.result()
+        thumbnail = result.pop('thumbnail', None)
+        result['thumbnail'] = self.thumbnails.get(key) if thumbnail is None else self.thumbnail(key, thumbnail)
+        self.itemComplete.emit(batch_id, index, result)
+
+    def rendered(self, batch_id, index, path, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            if not isinstance(error, CancelledError):
+                self.renderError.emit(batch_id, index, f"{path}: {str(error)}")
+            return
+        self.renderComplete.emit(batch_id, index, future.result())
+
+    def thumbnail(self, key, small):
+        """推理进程缩小好的带框结果图，复制成独立于数组内存的 QImage（QPixmap 只能在界面线程中创建）"""
+        height, width = small.shape[:2]
+        thumbnail = QImage(small.data, width, height, small.strides[0], QImage.Format_BGR888).copy()
+        self.thumbnails.put(key, thumbnail)
+        return thumbnail
 
 
 class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
+    saveFinished = pyqtSignal(str, str)  # 后台保存结束信号(提示信息, 错误信息)
+    poolEvent = pyqtSignal(str, int, object)  # 推理进程事件信号(事件, 进程序号, 数据)，见 workerPool
+
     def __init__(self):
         super().__init__()
         self.setupUi(self)
@@ -39,17 +207,147 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
 
         # 初始化变量
         self.or_emo_path = ""
-        self.combined_img_path = ""
-        self.worker = None
+        self.result = None  # 最近一次的分析结果
+        self.result_qimage = None  # 与结果数组共享内存的 QImage，需要和数组一起保留
+        self.current_job = 0
+
+        # 多图队列：每张图片的轻量结果（人脸结果和文字，不含结果图）全部保留，
+        # 带结果图的完整结果只在 LRU 中保留最近的几张，点击时不需要重新推理
+        self.queue_paths = []
+        self.queue_batch = 0
+        self.queue_options = None
+        self.queue_results = {}  # 序号 -> objs / summary / emotion_text / timings / cached
+        self.queue_errors = {}  # 序号 -> 错误信息
+        self.queue_done = 0
+        self.full_results = lruCache(RESULT_CACHE_SIZE)
+
+        # 分析模式选择，放在“开始检测”按钮上方
+        self.action_box = QtWidgets.QComboBox(self)
+        for profile, name in PROFILE_NAMES.items():
+            if profile in ACTION_PROFILES:
+                self.action_box.addItem(name, profile)
+        self.verticalLayout.insertWidget(2, self.action_box, 0, QtCore.Qt.AlignHCenter)
+
+        # 人脸检测后端和对齐开关，用检测精度换取 CPU 时间
+        self.detector_box = QtWidgets.QComboBox(self)
+        self.detector_box.addItems(DETECTOR_BACKENDS)
+        self.verticalLayout.insertWidget(3, self.detector_box, 0, QtCore.Qt.AlignHCenter)
+        self.align_check = QtWidgets.QCheckBox("人脸对齐", self)
+        self.align_check.setChecked(True)
+        self.verticalLayout.insertWidget(4, self.align_check, 0, QtCore.Qt.AlignHCenter)
+
+        # 取消按钮，放在“开始检测”按钮下方
+        self.cancel_button = QtWidgets.QPushButton("取消检测", self)
+        self.cancel_button.setEnabled(False)
+        self.verticalLayout.insertWidget(6, self.cancel_button, 0, QtCore.Qt.AlignHCenter)
+
+        # 选择文件夹按钮，放在“上传图片”按钮下方
+        self.folder_button = QtWidgets.QPushButton("选择文件夹", self)
+        self.verticalLayout.insertWidget(1, self.folder_button, 0, QtCore.Qt.AlignHCenter)
+
+        # 多图结果列表（缩略图 + 主要情绪），放在窗口最右侧，选择多张图片或文件夹后显示
+        self.result_list = QtWidgets.QListWidget(self)
+        self.result_list.setIconSize(QtCore.QSize(THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        self.result_list.setUniformItemSizes(True)
+        self.result_list.setFixedWidth(THUMBNAIL_SIZE + 160)
+        self.result_list.setVisible(False)
+        self.horizontalLayout_4.addWidget(self.result_list)
+
+        # 模型状态和分析进度显示
+        self.status_label = QtWidgets.QLabel("正在加载依赖...", self)
+        self.status_label.setWordWrap(True)
+        self.verticalLayout.addWidget(self.status_label)
+        self.progress_bar = QtWidgets.QProgressBar(self)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.verticalLayout.addWidget(self.progress_bar)
+
+        # 推理进程池，整个程序生命周期内只创建一次，窗口显示后才启动；
+        # 进程事件在监控线程中产生，通过信号回到界面线程
+        self.core_loaded = False
+        self.pool = workerPool(INFERENCE_PROCESSES, job_timeout=JOB_TIMEOUT, on_event=self.poolEvent.emit)
+        self.poolEvent.connect(self.handle_pool_event)
+
+        # 单张分析
+        self.worker = AnalysisWorker(self.pool)
+        self.worker.analysisComplete.connect(self.handle_analysis_complete)
+        self.worker.analysisError.connect(self.handle_analysis_error)
+        self.worker.analysisProgress.connect(self.handle_analysis_progress)
+        self.worker.analysisCancelled.connect(self.handle_analysis_cancelled)
+
+        # 多图分析
+        self.batch = BatchRunner(self.pool)
+        self.batch.itemComplete.connect(self.handle_item_complete)
+        self.batch.itemError.connect(self.handle_item_error)
+        self.batch.renderComplete.connect(self.handle_render_complete)
+        self.batch.renderError.connect(self.handle_render_error)
 
         # 连接按钮到函数
         self.pushButton.clicked.connect(self.upload_image)
+        self.folder_button.clicked.connect(self.upload_folder)
+        self.result_list.currentRowChanged.connect(self.show_queue_item)
         self.pushButton_2.clicked.connect(self.start_detection)
         self.pushButton_3.clicked.connect(self.save_result)
+        self.saveFinished.connect(self.handle_save_finished)
+        self.cancel_button.clicked.connect(self.cancel_detection)
+        self.action_box.currentIndexChanged.connect(self.preload_models)
+        self.detector_box.currentIndexChanged.connect(self.preload_models)
 
         # 设置错误处理
         sys.excepthook = self.handle_exception
 
+        # 窗口显示后再在后台导入依赖、加载模型
+        QtCore.QTimer.singleShot(0, self.start_background)
+
+    def start_background(self):
+        """窗口显示后调用：记录启动耗时，启动推理进程（由它们导入依赖）并预加载模型"""
+        coreLoader.mark('window')
+        self.preload_models()
+        self.pool.start()
+
+    def preload_models(self):
+        """在推理进程中加载并预热当前分析模式所需的模型（已经加载过的模型不会重复加载）"""
+        options = self.analysis_options()
+        # 依赖还没导入完时保持“正在加载依赖”，预加载任务排在导入之后执行
+        if self.core_loaded:
+            self.status_label.setText("模型加载中...")
+        self.pool.preload(options['actions'], options['detector_backend'])
+
+    def analysis_options(self):
+        """当前界面上选择的分析参数"""
+        return {
+            'actions': self.action_box.currentData(),
+            'detector_backend': self.detector_box.currentText(),
+            'align': self.align_check.isChecked(),
+            # 大图在解码时缩小到分析分辨率上限，再缩小到 detect_max_side 检测，人脸框会换算回原图坐标
+            'max_side': DEFAULT_MAX_SIDE,
+            'detect_max_side': 1280,
+        }
+
+    @pyqtSlot(str, int, object)
+    def handle_pool_event(self, kind, slot, data):
+        """推理进程事件：依赖导入完成、模型就绪、加载失败、进程重启"""
+        if kind == 'loaded':
+            self.core_loaded = True
+            # 分析核心在推理进程中导入，导入耗时由推理进程报告
+            if 'import_core' in data['startup']:
+                coreLoader.record('import_core', data['startup']['import_core'])
+            self.status_label.setText("模型加载中...")
+        elif kind == 'ready':
+            coreLoader.mark('models_ready')
+            self.status_label.setText(f"模型已就绪 ({data})")
+        elif kind == 'failed':
+            self.status_label.setText("模型加载失败，检测时将重试")
+            self.write_error_log(data)
+        elif kind == 'restarted':
+            self.status_label.setText(f"推理进程 #{slot} 已重启（{data}）")
+            self.write_error_log(f"推理进程 #{slot} 退出: {data}")
+        self.status_label.setToolTip(f"启动耗时: {coreLoader.startup_text()}\n{self.pool.health_text()}")
+
+    def metrics_text(self):
+        """各阶段耗时和计数器：分析在推理进程中进行，合并界面进程和各推理进程的指标"""
+        return snapshot_text(merge_snapshots([metrics.snapshot(), self.pool.metrics_snapshot()]))
+
     def handle_exception(self, exc_type, exc_value, exc_traceback):
         """全局异常处理器"""
         error_msg = ''.join(traceback.format_exception(exc_type, exc_value, exc_traceback))
@@ -62,16 +360,22 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
         QMessageBox.critical(self, title, message)
 
     def upload_image(self):
-        """打开文件对话框并加载选定的图像"""
+        """打开文件对话框并加载选定的图像，选择多张时进入多图队列"""
         try:
             options = QFileDialog.Options()
-            file_name, _ = QFileDialog.getOpenFileName(
-                self, "选择图片", "", "图像文件 (*.png *.jpg *.jpeg *.bmp *.gif);;所有文件 (*)",
+            file_names, _ = QFileDialog.getOpenFileNames(
+                self, "选择图片", "", "图像文件 (*.png *.jpg *.jpeg *.bmp *.gif *.webp);;所有文件 (*)",
                 options=options
             )
 
-            if file_name:
-                self.or_emo_path = file_name
+            if len(file_names) > 1:
+                self.load_queue(file_names)
+            elif file_names:
+                # 换了新图片，之前还没完成的分析结果已经没有意义
+                self.cancel_detection()
+                self.clear_queue()
+                self.or_emo_path = file_names[0]
+                self.result = None
                 self.display_image(self.or_emo_path, self.org_img)
                 self.summary.clear()
                 self.text2.clear()
@@ -80,10 +384,74 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
         except Exception as e:
             self.show_error_message("上传图片错误", f"上传图片时发生错误: {str(e)}")
 
+    def upload_folder(self):
+        """选择文件夹，把其中的图片（包括子文件夹）全部加入多图队列"""
+        try:
+            folder = QFileDialog.getExistingDirectory(self, "选择文件夹")
+            if not folder:
+                return
+            paths = list(iter_images([folder]))
+            if not paths:
+                self.show_error_message("选择文件夹", "文件夹中没有图片")
+                return
+            self.load_queue(paths)
+        except Exception as e:
+            self.show_error_message("选择文件夹错误", f"读取文件夹时发生错误: {str(e)}")
+
+    def clear_queue(self):
+        """清空多图队列和结果列表"""
+        self.batch.cancel()
+        self.queue_batch = 0
+        self.queue_paths = []
+        self.queue_results.clear()
+        self.queue_errors.clear()
+        self.full_results.clear()
+        self.result_list.clear()
+        self.result_list.setVisible(False)
+
+    def load_queue(self, paths):
+        """把多张图片放进结果列表，点击“开始检测”后并行分析"""
+        self.cancel_detection()
+        self.clear_queue()
+        self.queue_paths = list(paths)
+        for path in self.queue_paths:
+            item = QtWidgets.QListWidgetItem(f"{os.path.basename(path)}\n等待分析")
+            item.setToolTip(path)
+            self.result_list.addItem(item)
+        self.result_list.setVisible(True)
+
+        self.or_emo_path = self.queue_paths[0]
+        self.result = None
+        self.display_image(self.or_emo_path, self.org_img)
+        self.summary.setText(f"已选择 {len(self.queue_paths)} 张图片，点击“开始检测”进行分析")
+        self.text2.clear()
+        self.combined_img.setScene(QGraphicsScene())
+
     def display_image(self, image_path, graphics_view):
-        """在指定的图像视图中显示图像"""
+        """在指定的图像视图中显示图像：按 EXIF 方向旋转（与分析时 OpenCV 的解码一致），大图直接按缩小尺寸解码"""
+        try:
+            reader = QImageReader(image_path)
+            reader.setAutoTransform(True)
+            size = reader.size()
+            if size.isValid() and max(size.width(), size.height()) > DEFAULT_MAX_SIDE:
+                reader.setScaledSize(size.scaled(DEFAULT_MAX_SIDE, DEFAULT_MAX_SIDE, QtCore.Qt.KeepAspectRatio))
+            pixmap = QPixmap.fromImage(reader.read())
+            scene = QGraphicsScene()
+            scene.addPixmap(pixmap)
+            graphics_view.setScene(scene)
+            graphics_view.fitInView(scene.sceneRect(), QtCore.Qt.KeepAspectRatio)
+        except Exception as e:
+            self.show_error_message("显示图像错误", f"显示图像时发生错误: {str(e)}")
+
+    def display_array(self, img, graphics_view):
+        """直接显示内存中的 BGR 图片数组，不经过磁盘"""
         try:
-            pixmap = QPixmap(image_path)
+            import numpy as np  # 结果数组来自推理进程，第一次显示结果时才在界面进程中导入 NumPy
+            img = np.ascontiguousarray(img)
+            height, width = img.shape[:2]
+            # QImage 直接引用数组内存（零拷贝），转换为 QPixmap 时只复制一次
+            self.result_qimage = (img, QImage(img.data, width, height, img.strides[0], QImage.Format_BGR888))
+            pixmap = QPixmap.fromImage(self.result_qimage[1])
             scene = QGraphicsScene()
             scene.addPixmap(pixmap)
             graphics_view.setScene(scene)
@@ -97,34 +465,189 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
             self.show_error_message("错误", "请先上传图片")
             return
 
+        if self.queue_paths:
+            self.start_batch()
+            return
+
         # 显示加载指示
         self.summary.setText("正在分析中，请稍候...")
-        self.pushButton_2.setEnabled(False)
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(0)
+        self.cancel_button.setEnabled(True)
 
-        # 创建并启动工作线程
-        self.worker = AnalysisWorker(self.or_emo_path)
-        self.worker.analysisComplete.connect(self.handle_analysis_complete)
-        self.worker.analysisError.connect(self.handle_analysis_error)
-        self.worker.finished.connect(lambda: self.pushButton_2.setEnabled(True))
-        self.worker.start()
+        # 把任务交给推理进程，重复点击时只保留最新的任务
+        self.current_job = self.worker.submit(self.or_emo_path, self.analysis_options())
+
+    def start_batch(self):
+        """多图队列：所有图片交给推理进程池并行分析，进度条显示已完成的图片数"""
+        self.queue_results.clear()
+        self.queue_errors.clear()
+        self.full_results.clear()
+        self.queue_done = 0
+        for index, path in enumerate(self.queue_paths):
+            item = self.result_list.item(index)
+            item.setText(f"{os.path.basename(path)}\n等待分析")
+            item.setToolTip(path)
+
+        self.summary.setText(f"正在分析 {len(self.queue_paths)} 张图片，请稍候...")
+        self.progress_bar.setRange(0, len(self.queue_paths))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("%v/%m")
+        self.cancel_button.setEnabled(True)
+        self.queue_options = self.analysis_options()
+        self.queue_batch = self.batch.start(self.queue_paths, self.queue_options)
 
-    @pyqtSlot(str, str, str, str)
-    def handle_analysis_complete(self, summary_text, emotion_text, redbox_path, combined_img_path):
+    def cancel_detection(self):
+        """取消正在进行和排队中的分析任务"""
+        if self.cancel_button.isEnabled():
+            self.worker.cancel()
+            self.batch.cancel()
+            self.summary.setText("分析已取消")
+        self.cancel_button.setEnabled(False)
+        self.progress_bar.setValue(0)
+
+    @pyqtSlot(int, int, str)
+    def handle_analysis_progress(self, job_id, percent, stage):
+        """处理分析进度信号"""
+        if job_id == self.current_job:
+            self.progress_bar.setValue(percent)
+            self.progress_bar.setFormat(f"{STAGE_NAMES.get(stage, stage)} %p%")
+
+    @pyqtSlot(int)
+    def handle_analysis_cancelled(self, job_id):
+        """处理任务取消信号"""
+        if job_id == self.current_job:
+            self.cancel_button.setEnabled(False)
+
+    def timing_status(self, result):
+        """最近一次分析的各阶段耗时，显示在状态栏"""
+        if result['cached']:
+            return f"命中缓存 ({timings_text(result['timings'])})"
+        return f"本次耗时: {timings_text(result['timings'])}"
+
+    @pyqtSlot(int, object)
+    def handle_analysis_complete(self, job_id, result):
         """处理分析完成信号"""
+        if job_id != self.current_job:
+            return  # 过期任务的结果
+        self.cancel_button.setEnabled(False)
+        self.show_result(result)
+
+    def show_result(self, result):
+        """显示一次分析的完整结果"""
         try:
-            self.summary.setText(summary_text)
-            self.text2.setText(emotion_text)
-            self.combined_img_path = combined_img_path
-            self.display_image(combined_img_path, self.combined_img)
+            self.summary.setText(result['summary'])
+            self.text2.setText(result['emotion_text'])
+            self.result = result
+            self.display_array(result['combined_img'], self.combined_img)
+            self.status_label.setText(self.timing_status(result))
+            self.status_label.setToolTip(f"{self.metrics_text()}\n{self.pool.health_text()}")
         except Exception as e:
             self.show_error_message("结果显示错误", f"显示分析结果时发生错误: {str(e)}")
 
-    @pyqtSlot(str)
-    def handle_analysis_error(self, error_message):
+    def dominant_text(self, objs):
+        """结果列表中显示的主要情绪（去重，按人脸顺序）"""
+        emotions = [obj['dominant_emotion'] for obj in objs if obj.get('dominant_emotion')]
+        if not emotions:
+            return f"{len(objs)} 张人脸"
+        return f"{'、'.join(dict.fromkeys(emotions))} ({len(objs)} 张人脸)"
+
+    @pyqtSlot(int, int, object)
+    def handle_item_complete(self, batch_id, index, result):
+        """多图队列中一张图片分析完成：更新缩略图和主要情绪，完整结果放进 LRU"""
+        if batch_id != self.queue_batch:
+            return
+        thumbnail = result.pop('thumbnail')
+        self.queue_results[index] = {key: result[key] for key in
+                                     ('objs', 'summary', 'emotion_text', 'timings', 'cached')}
+        self.full_results.put(index, result)
+
+        item = self.result_list.item(index)
+        if thumbnail is not None:
+            item.setIcon(QtGui.QIcon(QPixmap.fromImage(thumbnail)))
+        item.setText(f"{os.path.basename(self.queue_paths[index])}\n{self.dominant_text(result['objs'])}")
+        if self.result_list.currentRow() == index:
+            self.show_result(result)
+        self.advance_queue()
+
+    @pyqtSlot(int, int, str)
+    def handle_item_error(self, batch_id, index, error_message):
+        """多图队列中一张图片分析失败：只在列表中标记并写日志，不弹出对话框"""
+        if batch_id != self.queue_batch:
+            return
+        self.queue_errors[index] = error_message
+        item = self.result_list.item(index)
+        item.setText(f"{os.path.basename(self.queue_paths[index])}\n分析失败")
+        item.setToolTip(error_message.splitlines()[0])
+        self.write_error_log(error_message)
+        if self.result_list.currentRow() == index:
+            self.summary.setText(error_message.splitlines()[0])
+        self.advance_queue()
+
+    def advance_queue(self):
+        self.queue_done += 1
+        self.progress_bar.setValue(self.queue_done)
+        if self.queue_done == len(self.queue_paths):
+            self.cancel_button.setEnabled(False)
+            self.status_label.setText(f"已完成 {len(self.queue_paths)} 张图片，失败 {len(self.queue_errors)} 张")
+            self.status_label.setToolTip(self.metrics_text())
+            if self.result is None and self.result_list.currentRow() < 0:
+                self.result_list.setCurrentRow(0)
+
+    def show_queue_item(self, index):
+        """点击结果列表：结果图还在缓存中时立即显示，否则先显示文字结果，再在后台用已有结果重新绘制"""
+        if index < 0 or index >= len(self.queue_paths):
+            return
+        self.or_emo_path = self.queue_paths[index]
+        self.display_image(self.or_emo_path, self.org_img)
+        result = self.full_results.get(index)
+        if result is not None:
+            self.show_result(result)
+            return
+
+        self.result = None
+        self.combined_img.setScene(QGraphicsScene())
+        partial = self.queue_results.get(index)
+        if partial is None:
+            self.summary.setText(self.queue_errors[index].splitlines()[0] if index in self.queue_errors
+                                 else "等待分析...")
+            self.text2.clear()
+            return
+        self.summary.setText(partial['summary'])
+        self.text2.setText(partial['emotion_text'])
+        self.batch.render(self.queue_batch, index, self.or_emo_path, partial['objs'], self.queue_options)
+
+    @pyqtSlot(int, int, object)
+    def handle_render_complete(self, batch_id, index, result):
+        """重新绘制完成，结果仍是当前批次的才放回缓存"""
+        partial = self.queue_results.get(index)
+        if batch_id != self.queue_batch or partial is None:
+            return
+        result['timings'], result['cached'] = partial['timings'], partial['cached']
+        self.full_results.put(index, result)
+        if self.result_list.currentRow() == index:
+            self.show_result(result)
+
+    @pyqtSlot(int, int, str)
+    def handle_render_error(self, batch_id, index, error_message):
+        if batch_id != self.queue_batch:
+            return
+        self.write_error_log(error_message)
+        if self.result_list.currentRow() == index:
+            self.show_error_message("结果显示错误", error_message)
+
+    @pyqtSlot(int, str)
+    def handle_analysis_error(self, job_id, error_message):
         """处理分析错误信号"""
-        self.summary.setText(f"分析过程中发生错误，请检查日志")
+        if job_id != self.current_job:
+            return
+        self.cancel_button.setEnabled(False)
+        self.summary.setText("分析过程中发生错误，请检查日志")
         self.show_error_message("分析错误", error_message)
-        # 将错误信息写入日志文件
+        self.write_error_log(error_message)
+
+    def write_error_log(self, error_message):
+        """将错误信息写入日志文件"""
         try:
             with open("error_log.txt", "a") as log_file:
                 log_file.write(f"\n--- {QtCore.QDateTime.currentDateTime().toString()} ---\n")
@@ -134,19 +657,56 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
             pass  # 如果日志写入失败，我们不希望引发另一个异常
 
     def save_result(self):
-        """保存分析结果"""
+        """保存分析结果：选择路径、格式和质量后交给推理进程编码写盘（结果图通过共享内存传过去）"""
         try:
-            if not hasattr(self, 'combined_img_path') or not self.combined_img_path:
+            if self.result is None:
                 self.show_error_message("保存错误", "没有可保存的结果，请先进行分析")
                 return
 
-            # 显示保存路径
-            self.summary.append("--------------")
-            self.summary.append(f"图片已保存到: {self.combined_img_path}")
-            self.summary.append("--------------")
+            base_name, _ = os.path.splitext(self.or_emo_path)
+            file_name, _ = QFileDialog.getSaveFileName(
+                self, "保存结果", f"{base_name}_analyzed.png",
+                "PNG 图片 (*.png);;JPEG 图片 (*.jpg *.jpeg);;WebP 图片 (*.webp)"
+            )
+            if not file_name:
+                return
+
+            quality = 95
+            if os.path.splitext(file_name)[1].lower() in ('.jpg', '.jpeg', '.webp'):
+                quality, ok = QtWidgets.QInputDialog.getInt(self, "图片质量", "质量 (1-100):", 95, 1, 100)
+                if not ok:
+                    return
+
+            self.summary.append("正在保存...")
+            arrays = {key: self.result[key] for key in ('redbox_img', 'combined_img')}
+            future = self.pool.submit('save', {'output_path': file_name, 'quality': quality}, arrays=arrays)
+            future.add_done_callback(self.write_result)
         except Exception as e:
             self.show_error_message("保存结果错误", f"保存结果时发生错误: {str(e)}")
 
+    def write_result(self, future):
+        """保存任务结束（在进程池的监控线程中调用），通过信号回到界面线程"""
+        if future.cancelled():
+            self.saveFinished.emit("", "保存已取消")
+        elif future.exception() is not None:
+            self.saveFinished.emit("", str(future.exception()))
+        else:
+            result = future.result()
+            self.saveFinished.emit(
+                f"图片已保存到: {result['combined_path']}\n红框图已保存到: {result['redbox_path']}", "")
+
+    @pyqtSlot(str, str)
+    def handle_save_finished(self, message, error_message):
+        """处理后台保存结束信号"""
+        if error_message:
+            self.show_error_message("保存结果错误", f"保存结果时发生错误: {error_message}")
+            return
+
+        # 显示保存路径
+        self.summary.append("--------------")
+        self.summary.append(message)
+        self.summary.append("--------------")
+
     def resizeEvent(self, event):
         """窗口大小改变时保持图像纵横比"""
         super().resizeEvent(event)
@@ -157,7 +717,7 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
                 if self.org_img.scene():
                     self.org_img.fitInView(self.org_img.scene().sceneRect(), QtCore.Qt.KeepAspectRatio)
 
-            if hasattr(self, 'combined_img_path') and self.combined_img_path:
+            if getattr(self, 'result', None) is not None:
                 if self.combined_img.scene():
                     self.combined_img.fitInView(self.combined_img.scene().sceneRect(), QtCore.Qt.KeepAspectRatio)
         except Exception as e:
@@ -165,14 +725,15 @@ class EmotionDetectionApp(QtWidgets.QDialog, Ui_Dialog):
             print(f"调整大小时出错: {str(e)}")
 
     def closeEvent(self, event):
-        """窗口关闭时确保线程正确结束"""
-        if self.worker and self.worker.isRunning():
-            self.worker.quit()
-            self.worker.wait()
+        """窗口关闭时结束推理进程：排队的任务直接丢弃，推理中的进程等待片刻后强制结束"""
+        self.batch.cancel()
+        self.worker.cancel()
+        self.pool.close()
         event.accept()
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 打包成可执行文件时推理进程需要
     try:
         app = QtWidgets.QApplication(sys.argv)
         window = EmotionDetectionApp()
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from EmoAna import deepAnalysis, DEFAULT_DETECTOR, EMOTION_LABELS
+from EmoMetrics import stageTimer
+from realtime import faceTracker
+
+# 离线视频分析：按流逐帧解码，按 sample_fps 采样，画面几乎没有变化的采样帧直接跳过，
+# 结果写成按列存储的时间线（时间戳、人脸编号、人脸框、情绪概率），而不是每帧一条 JSON。
+# 结果按块追加写盘，内存占用与视频长度无关。
+
+
+# 按列存储的时间线：目录下每列一个原始二进制文件，meta.json 记录类型、形状和标签顺序，
+# 读取时用 np.memmap 直接映射（见 load_timeline）
+class timelineWriter:
+    COLUMNS = {
+        'timestamp': (np.float64, ()),  # 秒
+        'frame': (np.int64, ()),
+        'face_id': (np.int32, ()),
+        'box': (np.int32, (4,)),  # x, y, w, h（原始分辨率坐标）
+        'emotion': (np.float32, (len(EMOTION_LABELS),)),  # 百分比，列顺序为 EMOTION_LABELS
+    }
+
+    def __init__(self, path, chunk_rows=4096, meta=None):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.meta = meta or {}
+        self.rows = 0
+        self.buffer = {name: [] for name in self.COLUMNS}
+        self.buffered = 0
+        os.makedirs(path, exist_ok=True)
+        self.files = {name: open(os.path.join(path, f"{name}.bin"), 'wb') for name in self.COLUMNS}
+
+    def append(self, timestamp, frame, face_ids, boxes, emotions):
+        count = len(face_ids)
+        if not count:
+            return
+        self.buffer['timestamp'].append(np.full(count, timestamp, dtype=np.float64))
+        self.buffer['frame'].append(np.full(count, frame, dtype=np.int64))
+        self.buffer['face_id'].append(np.asarray(face_ids, dtype=np.int32))
+        self.buffer['box'].append(np.asarray(boxes, dtype=np.int32).reshape(count, 4))
+        self.buffer['emotion'].append(np.asarray(emotions, dtype=np.float32).reshape(count, -1))
+        self.buffered += count
+        if self.buffered >= self.chunk_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.buffered:
+            return
+        for name, parts in self.buffer.items():
+            np.concatenate(parts).tofile(self.files[name])
+            parts.clear()
+        self.rows += self.buffered
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        meta = dict(self.meta, rows=self.rows, emotion_labels=EMOTION_LABELS,
+                    columns={name: {'dtype': np.dtype(dtype).str, 'shape': list(shape)}
+                             for name, (dtype, shape) in self.COLUMNS.items()})
+        with open(os.path.join(self.path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2, ensure_ascii=False)
+
+
+# 读取时间线：返回 (meta, {列名: 只读 memmap})，不会把整列读入内存
+def load_timeline(path):
+    with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    columns = {}
+    for name, column in meta['columns'].items():
+        shape = (meta['rows'], *column['shape'])
+        if meta['rows']:
+            columns[name] = np.memmap(os.path.join(path, f"{name}.bin"), dtype=np.dtype(column['dtype']), mode='r',
+                                      shape=shape)
+        else:
+            columns[name] = np.zeros(shape, dtype=np.dtype(column['dtype']))
+    return meta, columns
+
+
+# 低分辨率灰度缩略图，用来廉价地判断两帧是否几乎相同
+def frame_thumbnail(frame, size=(64, 36)):
+    return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+def draw_results(frame, results):
+    for face_id, (x, y, w, h), probs in results:
+        emotion = EMOTION_LABELS[int(np.argmax(probs))]
+        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+        cv2.putText(frame, f"#{face_id} {emotion} {probs.max():.0f}%", (x, max(y - 8, 16)),
+                    cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+    return frame
+
+
+# sample_fps 为每秒分析的帧数；diff_threshold 为缩略图平均灰度差，低于它的采样帧视为重复帧跳过；
+# render_path 不为空时输出带标注的视频（此时每一帧都需要解码，未分析的帧沿用最近一次的结果）
+def VideoTimeline(video_path, output_path, sample_fps=5.0, diff_threshold=2.0, detector_backend=DEFAULT_DETECTOR,
+                  align=True, detect_max_side=640, render_path=None, chunk_rows=4096, progress=None):
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError(f"无法打开视频: {video_path}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+    total_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT) or 0)
+
+    writer = timelineWriter(output_path, chunk_rows, meta={'source': os.path.abspath(video_path), 'fps': fps,
+                                                           'sample_fps': sample_fps})
+    video_writer = None
+    tracker = faceTracker()
+    timer = stageTimer()
+    stats = {'frames': 0, 'sampled': 0, 'duplicates': 0, 'analysed': 0, 'faces': 0}
+    start = time.perf_counter()
+
+    interval = 1.0 / sample_fps if sample_fps else 0.0
+    next_sample = 0.0
+    last_thumbnail = None
+    results = []
+    index = -1
+    try:
+        while True:
+            index += 1
+            timestamp = index / fps
+            sample = timestamp + 1e-9 >= next_sample
+            # 不采样也不输出视频的帧只 grab 不解码
+            if not sample and not render_path:
+                if not capture.grab():
+                    break
+                continue
+            with timer.span('decode'):
+                ok, frame = capture.read()
+            if not ok:
+                break
+
+            if sample:
+                next_sample += interval
+                stats['sampled'] += 1
+                thumbnail = frame_thumbnail(frame)
+                if last_thumbnail is not None and np.abs(thumbnail - last_thumbnail).mean() < diff_threshold:
+                    stats['duplicates'] += 1
+                else:
+                    last_thumbnail = thumbnail
+                    results = analyse_frame(frame, tracker, timer, detector_backend, align, detect_max_side)
+                    stats['analysed'] += 1
+                    stats['faces'] += len(results)
+                    writer.append(timestamp, index, [face_id for face_id, _, _ in results],
+                                  [box for _, box, _ in results], [probs for _, _, probs in results])
+                    if progress and total_frames:
+                        progress(index + 1, total_frames)
+
+            if render_path:
+                with timer.span('render'):
+                    if video_writer is None:
+                        height, width = frame.shape[:2]
+                        video_writer = cv2.VideoWriter(render_path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                                       (width, height))
+                    video_writer.write(draw_results(frame, results))
+    finally:
+        capture.release()
+        if video_writer is not None:
+            video_writer.release()
+        writer.close()
+
+    stats['frames'] = index
+    stats['rows'] = writer.rows
+    stats['seconds'] = time.perf_counter() - start
+    stats['timings'] = timer.spans
+    return stats
+
+
+# 检测 + 跟踪编号 + 一次批量情绪推理，返回 [(人脸编号, (x, y, w, h), 情绪概率)]
+def analyse_frame(frame, tracker, timer, detector_backend, align, detect_max_side):
+    with timer.span('detect'):
+        faces = deepAnalysis.detect_faces(frame, detector_backend=detector_backend, align=align,
+                                          detect_max_side=detect_max_side)
+    # 没有检测到人脸时 DeepFace 会返回整张图（confidence 为 0），需要过滤掉；
+    # 不能比较宽高，缩小检测后换算回原图的尺寸可能差一个像素
+    faces = [face for face in faces if face['confidence'] and face['face'].shape[0] > 0 and face['face'].shape[1] > 0]
+    boxes = [tuple(int(face['facial_area'][key]) for key in ('x', 'y', 'w', 'h')) for face in faces]
+    face_ids = tracker.update_detections(boxes, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    if not faces:
+        return []
+
+    emotion = deepAnalysis.predict_arrays(faces, ['emotion'], timer=timer).emotion
+    return list(zip(face_ids, boxes, emotion))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="离线视频表情分析，输出按列存储的情绪时间线")
+    parser.add_argument('video', help="视频文件")
+    parser.add_argument('-o', '--output', help="时间线目录，默认为 <视频名>_timeline")
+    parser.add_argument('--sample-fps', type=float, default=5.0, help="每秒分析的帧数，0 表示每帧都分析")
+    parser.add_argument('--diff-threshold', type=float, default=2.0, help="与上次分析帧的平均灰度差低于该值时跳过")
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR, help="DeepFace 人脸检测后端")
+    parser.add_argument('--no-align', action='store_true', help="关闭人脸对齐")
+    parser.add_argument('--detect-max-side', type=int, default=640, help="检测前把帧缩小到的最长边")
+    parser.add_argument('--render', help="输出带标注的视频文件")
+    args = parser.parse_args()
+
+    output_path = args.output or f"{os.path.splitext(args.video)[0]}_timeline"
+    stats = VideoTimeline(args.video, output_path, sample_fps=args.sample_fps, diff_threshold=args.diff_threshold,
+                          detector_backend=args.detector, align=not args.no_align,
+                          detect_max_side=args.detect_max_side, render_path=args.render,
+                          progress=lambda done, total: print(f"\r{done}/{total}", end='', file=sys.stderr))
+    print(f"\n共 {stats['frames']} 帧，采样 {stats['sampled']}，跳过重复 {stats['duplicates']}，"
+          f"分析 {stats['analysed']}，写入 {stats['rows']} 行，耗时 {stats['seconds']:.1f}s", file=sys.stderr)
+    print(f"时间线已保存至: {output_path}", file=sys.stderr)
@@ -1,8 +1,398 @@
-from deepface import DeepFace
+import argparse
+import glob
+import os
+import queue
+import threading
+import time
+
 import cv2
 import numpy as np
 
-# 分析人脸
-# img_path = "qqemo/1.jpeg"
-# objs = DeepFace.analyze(img_path=img_path, actions=['age', 'gender', 'race', 'emotion'])
-DeepFace.stream("database")
\ No newline at end of file
+from EmoAna import deepAnalysis, DEFAULT_DETECTOR, EMOTION_LABELS
+from EmoIndex import faceIndex
+
+# 实时表情分析：采集、检测/跟踪、推理、绘制四个阶段分别运行，阶段之间用有界队列连接。
+# 摄像头输入时队列满了会丢弃旧帧，保证画面总是最新的；视频文件 / 图片序列输入时不丢帧，
+# 可以在没有显示器的 CPU 服务器上离线运行。
+# 传入人脸身份索引（EmoIndex.faceIndex）时，每条新轨迹只查询一次身份，之后随跟踪编号沿用。
+# 原来的版本: DeepFace.stream("database")
+
+
+# 有界队列：drop=True 时满了丢弃最旧的一项，否则阻塞等待下游
+class latestQueue:
+    def __init__(self, maxsize=2, drop=True):
+        self.queue = queue.Queue(maxsize)
+        self.drop = drop
+        self.dropped = 0
+
+    def put(self, item):
+        if not self.drop:
+            self.queue.put(item)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        return self.queue.get(timeout=timeout)
+
+
+# 帧来源：摄像头编号、视频文件、图片目录或通配符（如 "frames/*.jpg"）
+class frameSource:
+    def __init__(self, source):
+        self.capture = None
+        self.files = None
+        self.live = False
+
+        if str(source).isdigit():
+            self.capture = cv2.VideoCapture(int(source))
+            self.live = True
+        elif os.path.isdir(source):
+            self.files = sorted(os.path.join(source, name) for name in os.listdir(source)
+                                if name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')))
+        elif any(char in source for char in '*?['):
+            self.files = sorted(glob.glob(source))
+        else:
+            self.capture = cv2.VideoCapture(source)
+
+        if self.capture is not None and not self.capture.isOpened():
+            raise ValueError(f"无法打开视频源: {source}")
+        self.position = 0
+
+    def fps(self):
+        if self.capture is not None:
+            return self.capture.get(cv2.CAP_PROP_FPS) or 25.0
+        return 25.0
+
+    def read(self):
+        if self.capture is not None:
+            ok, frame = self.capture.read()
+            return frame if ok else None
+
+        while self.position < len(self.files):
+            frame = cv2.imread(self.files[self.position])
+            self.position += 1
+            if frame is not None:
+                return frame
+        return None
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+
+
+def box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    inter_w = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    inter_h = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = inter_w * inter_h
+    union = aw * ah + bw * bh - inter
+    return inter / union if union > 0 else 0.0
+
+
+# 人脸跟踪：检测帧上按 IoU 把检测框和已有轨迹关联，给每张人脸一个稳定的编号；
+# 两次检测之间在上一帧框附近做模板匹配来跟随人脸移动
+class faceTracker:
+    def __init__(self, iou_threshold=0.3, max_missed=3, match_threshold=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_missed = max_missed
+        self.match_threshold = match_threshold
+        self.tracks = {}  # 编号 -> {'box', 'missed', 'template'}
+        self.next_id = 1
+
+    # 返回每个检测框对应的轨迹编号
+    def update_detections(self, boxes, gray):
+        ids = [None] * len(boxes)
+        unmatched = set(self.tracks)
+        pairs = sorted(((box_iou(track['box'], box), track_id, index)
+                        for track_id, track in self.tracks.items() for index, box in enumerate(boxes)), reverse=True)
+        used = set()
+        for iou, track_id, index in pairs:
+            if iou < self.iou_threshold:
+                break
+            if track_id not in unmatched or index in used:
+                continue
+            unmatched.discard(track_id)
+            used.add(index)
+            ids[index] = track_id
+            self.tracks[track_id]['missed'] = 0
+            self._set_box(track_id, boxes[index], gray)
+
+        for index, box in enumerate(boxes):
+            if index not in used:
+                self.tracks[self.next_id] = {'missed': 0}
+                self._set_box(self.next_id, box, gray)
+                ids[index] = self.next_id
+                self.next_id += 1
+
+        for track_id in unmatched:
+            self.tracks[track_id]['missed'] += 1
+            if self.tracks[track_id]['missed'] > self.max_missed:
+                del self.tracks[track_id]
+        return ids
+
+    def update_motion(self, gray):
+        height, width = gray.shape[:2]
+        for track_id, track in self.tracks.items():
+            x, y, w, h = track['box']
+            # 在原位置周围半个框大小的范围内搜索
+            x0, y0 = max(0, x - w // 2), max(0, y - h // 2)
+            x1, y1 = min(width, x + w + w // 2), min(height, y + h + h // 2)
+            search = gray[y0:y1, x0:x1]
+            template = track['template']
+            if search.shape[0] < template.shape[0] or search.shape[1] < template.shape[1] or template.size == 0:
+                continue
+            scores = cv2.matchTemplate(search, template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, location = cv2.minMaxLoc(scores)
+            if score >= self.match_threshold:
+                self._set_box(track_id, (x0 + location[0], y0 + location[1], w, h), gray)
+
+    def _set_box(self, track_id, box, gray):
+        x, y, w, h = [int(v) for v in box]
+        track = self.tracks[track_id]
+        track['box'] = (x, y, w, h)
+        track['template'] = gray[max(0, y):y + h, max(0, x):x + w].copy()
+
+    def snapshot(self):
+        return [(track_id, track['box']) for track_id, track in self.tracks.items()]
+
+
+# 各阶段耗时（指数滑动平均，毫秒）和帧率统计
+class streamStats:
+    def __init__(self, alpha=0.1):
+        self.alpha = alpha
+        self.latency = {}
+        self.frames = 0
+        self.start = time.perf_counter()
+        self.window_start = self.start
+        self.window_frames = 0
+        self.fps = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            ms = seconds * 1000
+            old = self.latency.get(stage)
+            self.latency[stage] = ms if old is None else old + self.alpha * (ms - old)
+
+    def frame_done(self):
+        with self.lock:
+            self.frames += 1
+            self.window_frames += 1
+            now = time.perf_counter()
+            if now - self.window_start >= 1.0:
+                self.fps = self.window_frames / (now - self.window_start)
+                self.window_start, self.window_frames = now, 0
+                return True
+        return False
+
+    def text(self):
+        stages = "  ".join(f"{stage}: {ms:.1f}ms" for stage, ms in self.latency.items())
+        return f"FPS: {self.fps:.1f}  {stages}"
+
+
+class streamPipeline:
+    def __init__(self, source, detect_every=5, detector_backend=DEFAULT_DETECTOR, smoothing=0.3, queue_size=2,
+                 align=True, detect_max_side=640, index=None):
+        self.source = frameSource(source)
+        self.detect_every = max(1, detect_every)
+        self.detector_backend = detector_backend
+        self.align = align
+        self.detect_max_side = detect_max_side
+        self.smoothing = smoothing  # 新预测在滑动平均中的权重
+
+        drop = self.source.live
+        self.captured = latestQueue(queue_size, drop)
+        self.detected = latestQueue(queue_size, drop)
+        self.inferred = latestQueue(queue_size, drop)
+
+        self.tracker = faceTracker()
+        self.smoothed = {}  # 人脸编号 -> 平滑后的情绪概率
+        self.index = index
+        self.identities = {}  # 人脸编号 -> 身份（没有匹配上时为 None）
+        self.stats = streamStats()
+        self.running = threading.Event()
+        self.error = None
+
+    def capture_loop(self):
+        index = 0
+        while self.running.is_set():
+            start = time.perf_counter()
+            frame = self.source.read()
+            if frame is None:
+                break
+            self.stats.record('capture', time.perf_counter() - start)
+            self.captured.put((index, time.perf_counter(), frame))
+            index += 1
+        self.captured.put(None)
+
+    def detect_loop(self):
+        processed = 0  # 实际处理的帧数：drop=True 时采集编号不连续，按它判断会拉长或跳过重新检测
+        while True:
+            item = self.captured.get()
+            if item is None:
+                break
+            index, captured_at, frame = item
+            start = time.perf_counter()
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            if processed % self.detect_every == 0:
+                faces = deepAnalysis.detect_faces(frame, detector_backend=self.detector_backend, align=self.align,
+                                                  detect_max_side=self.detect_max_side)
+                # 没有检测到人脸时 DeepFace 会返回整张图（confidence 为 0），需要过滤掉；
+                # 不能比较宽高，缩小检测后换算回原图的尺寸可能差一个像素
+                boxes = [(area['x'], area['y'], area['w'], area['h']) for area in
+                         (face['facial_area'] for face in faces if face['confidence'])]
+                self.tracker.update_detections(boxes, gray)
+                self.stats.record('detect', time.perf_counter() - start)
+            else:
+                self.tracker.update_motion(gray)
+                self.stats.record('track', time.perf_counter() - start)
+            processed += 1
+            self.detected.put((index, captured_at, frame, self.tracker.snapshot()))
+        self.detected.put(None)
+
+    def infer_loop(self):
+        while True:
+            item = self.detected.get()
+            if item is None:
+                break
+            index, captured_at, frame, tracks = item
+            start = time.perf_counter()
+            # 所有人脸裁剪后一起送入情绪模型，只做一次前向计算
+            valid, faces = [], []
+            for track_id, (x, y, w, h) in tracks:
+                crop = frame[max(0, y):y + h, max(0, x):x + w]
+                if crop.size == 0:
+                    continue
+                valid.append((track_id, (x, y, w, h)))
+                faces.append({'face': crop[:, :, ::-1] / 255.0, 'facial_area': {'x': x, 'y': y, 'w': w, 'h': h},
+                              'confidence': 1.0})
+            emotion = deepAnalysis.predict_arrays(faces, ['emotion']).emotion
+            if self.index is not None:
+                self.identify(valid, faces)
+
+            results = []
+            for (track_id, box), probs in zip(valid, emotion):
+                old = self.smoothed.get(track_id)
+                probs = probs if old is None else old + self.smoothing * (probs - old)
+                self.smoothed[track_id] = probs
+                results.append((track_id, box, probs))
+            # 已经消失的人脸不再保留平滑状态
+            for track_id in set(self.smoothed) - {track_id for track_id, _ in tracks}:
+                del self.smoothed[track_id]
+            for track_id in set(self.identities) - {track_id for track_id, _ in tracks}:
+                del self.identities[track_id]
+
+            self.stats.record('infer', time.perf_counter() - start)
+            self.inferred.put((index, captured_at, frame, results))
+        self.inferred.put(None)
+
+    # 只给还没有身份的新轨迹提取特征并查询索引，一次前向计算
+    def identify(self, valid, faces):
+        new = [i for i, (track_id, _) in enumerate(valid) if track_id not in self.identities]
+        if not new:
+            return
+        start = time.perf_counter()
+        embeddings = deepAnalysis.embed_faces([faces[i] for i in new], self.index.model_name)
+        matches = self.index.search(embeddings)
+        for i, obj in zip(new, self.index.record(embeddings, matches, [{} for _ in new])):
+            self.identities[valid[i][0]] = obj['identity']
+        self.stats.record('identify', time.perf_counter() - start)
+
+    def render(self, frame, results):
+        for track_id, (x, y, w, h), probs in results:
+            emotion = EMOTION_LABELS[int(np.argmax(probs))]
+            label = self.identities.get(track_id) or f"#{track_id}"
+            cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+            cv2.putText(frame, f"{label} {emotion} {probs.max():.0f}%", (x, max(y - 8, 16)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 255), 2)
+        cv2.putText(frame, self.stats.text(), (10, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
+        return frame
+
+    # 在当前线程中运行绘制阶段，其余阶段在后台线程中运行；
+    # on_frame(index, frame, results) 可选，用于测试或把结果交给其他程序
+    def run(self, display=False, output_path=None, on_frame=None):
+        self.running.set()
+        workers = [threading.Thread(target=self.guard, args=(loop,), daemon=True)
+                   for loop in (self.capture_loop, self.detect_loop, self.infer_loop)]
+        for worker in workers:
+            worker.start()
+
+        writer = None
+        try:
+            while True:
+                item = self.inferred.get()
+                if item is None:
+                    break
+                index, captured_at, frame, results = item
+                start = time.perf_counter()
+                frame = self.render(frame, results)
+                if output_path:
+                    if writer is None:
+                        height, width = frame.shape[:2]
+                        writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), self.source.fps(),
+                                                 (width, height))
+                    writer.write(frame)
+                if on_frame:
+                    on_frame(index, frame, results)
+                self.stats.record('render', time.perf_counter() - start)
+                self.stats.record('end_to_end', time.perf_counter() - captured_at)
+
+                if self.stats.frame_done() and not display:
+                    print(self.stats.text())
+                if display:
+                    cv2.imshow("Emotion Recognition", frame)
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        break
+        finally:
+            self.running.clear()
+            self.source.release()
+            if writer is not None:
+                writer.release()
+            if display:
+                cv2.destroyAllWindows()
+
+        if self.error:
+            raise self.error
+        return self.stats
+
+    # 后台阶段出错时停止整条流水线，并把结束标记传给下游，避免主线程一直等待
+    def guard(self, loop):
+        try:
+            loop()
+        except Exception as e:
+            self.error = e
+            self.running.clear()
+            for stage_queue in (self.captured, self.detected, self.inferred):
+                stage_queue.drop = True
+                stage_queue.put(None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="实时表情分析（摄像头、视频文件或图片序列）")
+    parser.add_argument('--source', default='0', help="摄像头编号、视频文件、图片目录或通配符")
+    parser.add_argument('--detect-every', type=int, default=5, help="每隔多少帧做一次人脸检测，其余帧只跟踪")
+    parser.add_argument('--detector', default=DEFAULT_DETECTOR, help="DeepFace 人脸检测后端")
+    parser.add_argument('--no-align', action='store_true', help="关闭人脸对齐")
+    parser.add_argument('--detect-max-side', type=int, default=640, help="检测前把帧缩小到的最长边")
+    parser.add_argument('--smoothing', type=float, default=0.3, help="情绪概率平滑系数（越小越平滑）")
+    parser.add_argument('--output', help="把带标注的视频写到文件")
+    parser.add_argument('--headless', action='store_true', help="不显示窗口，只在终端输出帧率和各阶段耗时")
+    parser.add_argument('--index', nargs='?', const='', help="用人脸身份索引识别人物，可指定索引目录")
+    parser.add_argument('--enroll', action='store_true', help="把索引中没有的人脸自动登记为新人物")
+    args = parser.parse_args()
+
+    index = faceIndex(args.index or None, auto_enroll=args.enroll) if args.index is not None else None
+    pipeline = streamPipeline(args.source, detect_every=args.detect_every, detector_backend=args.detector,
+                              smoothing=args.smoothing, align=not args.no_align,
+                              detect_max_side=args.detect_max_side, index=index)
+    stats = pipeline.run(display=not args.headless, output_path=args.output)
+    print(f"共处理 {stats.frames} 帧，{stats.text()}")